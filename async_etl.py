@@ -0,0 +1,425 @@
+"""
+Асинхронный режим ETL: потоки данных и помесячные запросы выполняются конкурентно
+"""
+
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+import aiohttp
+import ijson
+from loguru import logger
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from http_client import JSONItemCollector, RateLimiter, RequestStats, RetryPolicy
+from loaders import (
+    UPSERT_BATCH_SIZE, advance_sync_cursor, get_completed_windows, get_sync_cursor, get_window_granularities,
+    mark_windows_completed, refresh_spend_rollups, save_balances, save_predictions, save_window_granularities,
+    upsert_project_reports, upsert_transactions
+)
+from models import create_async_db_engine
+from parsers import parse_balances, parse_predictions, parse_project_report, parse_transactions
+from selectel_etl import (
+    STREAMS, SelectelETL, TRANSACTIONS_PAGE_SIZE, finer_granularity, log_period_throughput, month_start
+)
+
+
+class AsyncSelectelHTTPClient:
+    def __init__(self, base_url, headers):
+        self.base_url = base_url
+        self.headers = dict(headers)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.policy = RetryPolicy()
+        self.rate_limiter = RateLimiter()
+        self.stats = RequestStats()
+        self.pool_size = int(os.getenv('HTTP_POOL_SIZE', 10))
+        self.session = None
+
+    async def open(self):
+        """Открыть пул соединений (должен вызываться внутри работающего event loop)"""
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=self.policy.timeout)
+        )
+
+    async def close(self):
+        """Закрыть пул соединений"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_json(self, endpoint, params=None):
+        """Выполнить GET-запрос с повторами и вернуть разобранный JSON"""
+        _, body = await self._send(endpoint, params)
+        return json.loads(body)
+
+    async def iter_json_items(self, endpoint, params=None, prefix='data', meta=None):
+        """Выполнить GET-запрос с повторами и потоково разобрать элементы массива prefix из ответа"""
+        response, _ = await self._send(endpoint, params, stream=True)
+        collector = JSONItemCollector(prefix, meta if meta is not None else {})
+        try:
+            async for path, event, value in ijson.parse(response.content, use_float=True):
+                done, item = collector.feed(path, event, value)
+                if done:
+                    yield item
+        finally:
+            response.release()
+
+    async def _send(self, endpoint, params=None, stream=False):
+        """Выполнить GET-запрос с повторами и вернуть (успешный ответ, тело или None при stream)"""
+        url = f"{self.base_url}{endpoint}"
+        attempt = 0
+
+        while True:
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            started = time.monotonic()
+            try:
+                response = await self.session.get(url, params=params)
+                # При потоковом чтении тело еще не получено, учитываем размер из заголовка
+                body = None if stream else await response.read()
+                size = (response.content_length or 0) if stream else len(body)
+                self.stats.record(endpoint, time.monotonic() - started, size, error=response.status >= 400)
+                delay = self.policy.retry_delay(response.status, response.headers, attempt)
+                if delay is None:
+                    if response.status >= 400:
+                        self.stats.record_failure(endpoint)
+                        response.release()
+                        response.raise_for_status()
+                    if not stream:
+                        response.release()
+                    return response, body
+                response.release()
+                logger.warning(f"Ответ {response.status} от {url}. Повтор через {delay:.1f} с")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.stats.record(endpoint, time.monotonic() - started, 0, error=True)
+                if attempt >= self.policy.max_retries:
+                    self.stats.record_failure(endpoint)
+                    raise
+                delay = self.policy.backoff_delay(attempt)
+                logger.warning(f"Сетевая ошибка при запросе к {url}: {e!r}. Повтор через {delay:.1f} с")
+
+            attempt += 1
+            self.stats.record_retry(endpoint)
+            await asyncio.sleep(delay)
+
+
+class AsyncSelectelETL(SelectelETL):
+    """ETL с конкурентной загрузкой потоков через aiohttp и asyncpg"""
+    # Разбор ответов и SQL-операции общие с синхронным режимом: функции из loaders
+    # выполняются через AsyncSession.run_sync поверх asyncpg-соединения
+
+    def __init__(self):
+        super().__init__()
+        self.async_http = AsyncSelectelHTTPClient(self.base_url, self.headers)
+        self._session_factory = None
+        self._semaphore = None
+
+    def _create_http_client(self):
+        # Синхронный клиент с requests.Session здесь не нужен: все запросы идут через aiohttp (self.async_http)
+        return None
+
+    def close(self):
+        """Пул соединений aiohttp открывается и закрывается внутри каждого run_etl, закрывать нечего"""
+
+    def run_etl(self, full_sync=False, period=None, streams=None, force=False):
+        """Запустить ETL-процесс в асинхронном режиме"""
+        try:
+            asyncio.run(self.run_etl_async(full_sync=full_sync, period=period, streams=streams, force=force))
+        except Exception as e:
+            logger.error(f"Критическая ошибка в ETL-процессе: {e}")
+
+    async def run_etl_async(self, full_sync=False, period=None, streams=None, force=False):
+        """Выполнить потоки (по умолчанию все) конкурентно и вернуть длительность каждого, с"""
+        streams = STREAMS if streams is None else streams
+        logger.info("Начало ETL-процесса (асинхронный режим)")
+        started = time.monotonic()
+        self.async_http.stats.reset()
+        self.ledger = self.ledger_class('async', full_sync)
+        self.ledger.start()
+        self._maintain_partitions()
+
+        # Пулы соединений привязаны к event loop, поэтому создаются на каждый запуск
+        engine = create_async_db_engine()
+        self._session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        # Общий лимит одновременных помесячных запросов для всех потоков
+        self._semaphore = asyncio.Semaphore(self.max_workers)
+        await self.async_http.open()
+
+        fetchers = {
+            'balances': self._fetch_balances_async,
+            'predictions': self._fetch_predictions_async,
+            'transactions': lambda: self._fetch_transactions_async(full_sync, period, force),
+            'project_reports': lambda: self._fetch_project_reports_async(full_sync, period, force)
+        }
+        try:
+            timings = dict(await asyncio.gather(*(
+                self._timed(stream, fetchers[stream]()) for stream in STREAMS if stream in streams
+            )))
+        finally:
+            await self.async_http.close()
+            await engine.dispose()
+            self.ledger.finish(self.async_http.stats.snapshot())
+
+        for stream, duration in timings.items():
+            logger.info(f"Поток {stream}: {duration:.2f} с")
+        logger.info(f"ETL-процесс завершен за {time.monotonic() - started:.2f} секунд")
+        self.async_http.stats.log()
+        return timings
+
+    async def _timed(self, stream, coro):
+        """Выполнить поток, перехватив ошибки, и вернуть (имя, длительность)"""
+        started = time.monotonic()
+        # Ошибку потока журнал фиксирует как провал этапа и не пробрасывает дальше
+        with self.ledger.stage(stream):
+            await coro
+        return stream, time.monotonic() - started
+
+    async def _make_request_async(self, endpoint, params=None):
+        """Выполнить HTTP-запрос к API Selectel"""
+        try:
+            return await self.async_http.get_json(endpoint, params)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка при запросе к {self.base_url}{endpoint}: {e!r}")
+            return None
+
+    async def _get_watermark_async(self, stream):
+        async with self._session_factory() as session:
+            return await session.run_sync(get_sync_cursor, stream)
+
+    async def _advance_watermark_async(self, stream, cursor):
+        async with self._session_factory() as session:
+            await session.run_sync(advance_sync_cursor, stream, cursor)
+            await session.commit()
+
+    async def _get_completed_windows_async(self, stream, start_date, end_date):
+        async with self._session_factory() as session:
+            return await session.run_sync(get_completed_windows, stream, month_start(start_date), end_date)
+
+    async def _mark_windows_completed_async(self, stream, windows):
+        if not windows:
+            return
+        try:
+            async with self._session_factory() as session:
+                await session.run_sync(mark_windows_completed, stream, windows)
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении загруженных окон {stream}: {e}")
+
+    async def _fetch_balances_async(self):
+        logger.info("Запрос данных о балансах...")
+        fetched_at = datetime.now()
+        data = await self._make_request_async('/v3/balances')
+        if not data:
+            return
+
+        async with self._session_factory() as session:
+            total_balances = await session.run_sync(save_balances, parse_balances(data))
+            await session.run_sync(advance_sync_cursor, 'balances', fetched_at)
+            await session.commit()
+        self._record_rows('balances', inserted=total_balances)
+        logger.info(f"Сохранено {total_balances} записей о балансах")
+
+    async def _fetch_predictions_async(self):
+        logger.info("Запрос данных о прогнозах...")
+        fetched_at = datetime.now()
+        data = await self._make_request_async('/v2/billing/prediction')
+        if not data:
+            return
+
+        async with self._session_factory() as session:
+            total_predictions = await session.run_sync(save_predictions, parse_predictions(data))
+            await session.run_sync(advance_sync_cursor, 'predictions', fetched_at)
+            await session.commit()
+        self._record_rows('predictions', inserted=total_predictions)
+        logger.info(f"Сохранено {total_predictions} записей о прогнозах")
+
+    async def _fetch_transactions_async(self, full_sync, period=None, force=False):
+        watermark = None if full_sync or period else await self._get_watermark_async('transactions')
+        start_date, end_date = self._plan_transactions_period(full_sync, watermark, period)
+        await asyncio.get_running_loop().run_in_executor(None, self._ensure_partitions, 'transactions', start_date, end_date)
+
+        # Период режется на календарные месяцы; замороженные (закрытые и уже загруженные) месяцы пропускаются
+        now = datetime.now()
+        windows = self._pending_windows(
+            'transactions', self._month_windows(start_date, end_date),
+            await self._get_completed_windows_async('transactions', start_date, end_date), force
+        )
+        # Месяцы сразу режутся на окна той гранулярности, которая понадобилась в прошлый раз
+        async with self._session_factory() as session:
+            granularities = await session.run_sync(get_window_granularities, month_start(start_date), end_date)
+        tasks = self._plan_transaction_tasks(windows, granularities)
+        # Раздробленные окна и окна с ошибкой возвращаются в gather следующим раундом
+        loaded = []
+        while tasks:
+            task_results = await asyncio.gather(*(self._fetch_transactions_window_async(task) for _, task in tasks))
+            tasks = self._collect_window_results(tasks, task_results, loaded)
+        results, granularities = self._merge_window_results(windows, loaded)
+        total_processed = sum(processed for processed in results if processed is not None)
+        logger.info(f"Всего обработано транзакций за весь период: {total_processed}")
+        await self._save_window_granularities_async(granularities)
+        await self._mark_windows_completed_async('transactions', self._closed_windows(windows, results, now))
+
+        # Агрегаты пересчитываем и при частичной загрузке: сохраненные страницы уже в БД
+        if windows:
+            async with self._session_factory() as session:
+                await session.run_sync(refresh_spend_rollups, start_date, end_date)
+                await session.commit()
+
+        # Водяной знак сдвигаем, только если все периоды успешно сохранены
+        if all(processed is not None for processed in results):
+            await self._advance_watermark_async('transactions', end_date)
+        else:
+            logger.warning("Не все периоды транзакций загружены, водяной знак не сдвинут")
+
+    async def _save_window_granularities_async(self, granularities):
+        if not granularities:
+            return
+        try:
+            async with self._session_factory() as session:
+                await session.run_sync(save_window_granularities, granularities)
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении гранулярности окон транзакций: {e}")
+
+    async def _fetch_transactions_window_async(self, task):
+        """Загрузить окно транзакций (TransactionWindowTask), вернуть (обработано или None, подокна)"""
+        start_date, end_date = task.window
+        async with self._semaphore:
+            logger.info(f"Запрос транзакций за период: {start_date.strftime('%Y-%m-%d %H:%M')} - {end_date.strftime('%Y-%m-%d %H:%M')}")
+            try:
+                async with self._session_factory() as session:
+                    return await self._fetch_transactions_adaptive_async(session, task)
+            except Exception as e:
+                self._transaction_window_failed(task, e)
+                return None, []
+
+    async def _fetch_transactions_adaptive_async(self, session, task):
+        """Загрузить окно; если первая страница заполнена до limit, вернуть подокна вместо загрузки"""
+        start_date, end_date = task.window
+        first_page = task.first_page
+        if first_page is None and finer_granularity(task.granularity):
+            params = self._transactions_page_params(start_date, end_date, 0)
+            first_page = [item async for item in self._iter_transaction_items_async(params)]
+        sub_tasks = self._split_transaction_task(task, first_page) if first_page is not None else []
+        if sub_tasks:
+            return 0, sub_tasks
+
+        return await self._fetch_transactions_period_async(session, start_date, end_date, first_page), []
+
+    async def _iter_transaction_items_async(self, params):
+        """Потоково получить транзакции одной страницы"""
+        meta = {}
+        async for item in self.async_http.iter_json_items('/v2/billing/transactions', params, meta=meta):
+            yield item
+        if meta.get('status') != 'success':
+            raise RuntimeError(f"не удалось получить страницу транзакций (offset={params['offset']}): статус {meta.get('status')}")
+
+    async def _iter_page_items_async(self, start_date, end_date, offset, first_page=None):
+        """Элементы страницы: уже полученная первая страница или потоковый запрос к API"""
+        if first_page is not None and offset == 0:
+            for item in first_page:
+                yield item
+            return
+        async for item in self._iter_transaction_items_async(self._transactions_page_params(start_date, end_date, offset)):
+            yield item
+
+    async def _fetch_transactions_period_async(self, session, start_date, end_date, first_page=None):
+        """Загрузить все страницы транзакций за период (first_page - уже полученная первая страница)"""
+        started = time.monotonic()
+        pages_count = 0
+        processed_total = 0
+        updated_total = 0
+        unchanged_total = 0
+        offset = 0
+
+        while True:
+            page_size = 0
+            batch = []
+            # Элементы разбираются из потока ответа и сохраняются пачками по UPSERT_BATCH_SIZE
+            async for item in self._iter_page_items_async(start_date, end_date, offset, first_page):
+                page_size += 1
+                batch.append(item)
+                if len(batch) >= UPSERT_BATCH_SIZE:
+                    processed, updated, unchanged = await self._save_transactions_batch_async(session, batch)
+                    processed_total += processed
+                    updated_total += updated
+                    unchanged_total += unchanged
+                    batch = []
+            if batch:
+                processed, updated, unchanged = await self._save_transactions_batch_async(session, batch)
+                processed_total += processed
+                updated_total += updated
+                unchanged_total += unchanged
+            if page_size:
+                pages_count += 1
+
+            # Неполная страница означает, что данные за период закончились
+            if page_size < TRANSACTIONS_PAGE_SIZE:
+                break
+            offset += page_size
+
+        log_period_throughput(
+            start_date, end_date, processed_total, updated_total, unchanged_total, pages_count, time.monotonic() - started
+        )
+        return processed_total
+
+    async def _save_transactions_batch_async(self, session, transactions_data):
+        """Сохранить пачку транзакций страницы, вернуть (обработано, обновлено, без изменений)"""
+        inserted, updated, unchanged = await session.run_sync(upsert_transactions, parse_transactions(transactions_data))
+        await session.commit()
+        self._record_rows('transactions', inserted, updated, unchanged)
+        return inserted + updated + unchanged, updated, unchanged
+
+    async def _fetch_project_reports_async(self, full_sync, period=None, force=False):
+        now = datetime.now()
+        watermark = None if full_sync or period else await self._get_watermark_async('project_reports')
+        windows = self._plan_project_report_windows(full_sync, watermark, now, period)
+        windows = self._pending_windows(
+            'project_reports', windows,
+            await self._get_completed_windows_async('project_reports', windows[0][0], windows[-1][1]), force
+        )
+
+        results = await asyncio.gather(*(self._fetch_project_report_async(start.year, start.month) for start, _ in windows))
+        await self._mark_windows_completed_async('project_reports', self._closed_windows(windows, results, now))
+        if all(results):
+            await self._advance_watermark_async('project_reports', now)
+        else:
+            logger.warning("Не все месяцы отчетов по проектам загружены, водяной знак не сдвинут")
+
+    async def _fetch_project_report_async(self, year, month):
+        """Загрузить отчет по проектам за месяц, False - при ошибке"""
+        async with self._semaphore:
+            logger.info(f"Запрос данных по проектам за {month}/{year}...")
+            params = {
+                'year': year,
+                'month': month,
+                'locale': 'ru'
+            }
+            data = await self._make_request_async('/v1/billing/report/by_project/detailed', params)
+
+            if not data or data.get('status') != 'success':
+                logger.warning(f"Не удалось получить данные по проектам за {month}/{year}")
+                self._record_error('project_reports', f"нет данных за {month}/{year}")
+                return False
+
+            try:
+                async with self._session_factory() as session:
+                    inserted_count, updated_count, unchanged_count = await session.run_sync(
+                        upsert_project_reports, parse_project_report(data, year, month)
+                    )
+                    await session.commit()
+                self._record_rows('project_reports', inserted_count, updated_count, unchanged_count)
+            except Exception as e:
+                logger.error(f"Ошибка при сборе отчетов по проектам за {month}/{year}: {e}")
+                self._record_error('project_reports', e)
+                return False
+
+        logger.info(
+            f"Обработано {inserted_count + updated_count + unchanged_count} записей по проектам за {month}/{year}: "
+            f"{inserted_count} новых, {updated_count} обновлено, {unchanged_count} без изменений"
+        )
+        return True
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк ETL: полный запуск SelectelETL против локального mock API
+
+Для каждого этапа выводит время, количество запросов к API, SQL-операторов и пиковую память.
+Данные пишутся в отдельную базу бенчмарка (--db-name или BENCH_DB_NAME, остальные параметры - из DB_*):
+mock API выдает id транзакций из того же диапазона, что и Selectel, и запуск в рабочей базе перезаписал бы
+настоящие транзакции, водяные знаки и агрегаты. Непустая база принимается только с --force.
+С --parse N выполняется только микробенчмарк разбора транзакций (без API и БД).
+"""
+
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from loaders import transaction_params
+from mock_selectel_api import MockBillingData, start_mock_server
+from models import get_engine
+from parsers import parse_transactions
+from run_ledger import RunLedger
+
+
+class StatementCounter:
+    """Счетчик SQL-операторов, отправленных всеми движками SQLAlchemy"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.value += 1
+
+
+statement_counter = StatementCounter()
+
+
+class BenchmarkLedger(RunLedger):
+    """Журнал запуска, который дополнительно замеряет SQL-операторы и пиковую память этапов"""
+
+    def __init__(self, mode, full_sync):
+        super().__init__(mode, full_sync)
+        self.measurements = {}
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        statements_before = statement_counter.value
+        tracemalloc.reset_peak()
+        with super().stage(name):
+            yield
+        self.measurements[name] = {
+            'db_statements': statement_counter.value - statements_before,
+            'peak_memory_mb': tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        }
+
+    def finish(self, http_stats):
+        self.records = super().finish(http_stats)
+        return self.records
+
+
+def bench_database_error(db_name, force):
+    """Направить ETL в базу бенчмарка; вернуть текст ошибки, если запускать в ней бенчмарк нельзя"""
+    production_db = os.getenv('DB_NAME', 'selectel_billing')
+    if not db_name:
+        return "не задана база бенчмарка: укажите --db-name или BENCH_DB_NAME (отдельную от DB_NAME базу)"
+    if db_name == production_db:
+        return f"база бенчмарка совпадает с рабочей базой DB_NAME={production_db}"
+    # Движок создается при первом обращении, поэтому вся дальнейшая работа идет с этой базой
+    os.environ['DB_NAME'] = db_name
+    try:
+        with get_engine().connect() as conn:
+            # Новая база еще без таблиц: их создадут миграции при инициализации ETL
+            has_transactions = conn.execute(text("SELECT to_regclass('transactions')")).scalar() is not None \
+                and conn.execute(text("SELECT EXISTS (SELECT 1 FROM transactions)")).scalar()
+    except OperationalError as e:
+        return f"база бенчмарка {db_name} недоступна (создайте ее заранее): {str(e.orig).strip()}"
+    if has_transactions and not force:
+        return f"в базе {db_name} уже есть транзакции; для повторного запуска в той же базе добавьте --force"
+    return None
+
+
+def reset_sync_progress(db_name):
+    """Забыть замороженные месяцы и найденное дробление окон транзакций в базе бенчмарка db_name
+
+    Иначе повторный запуск пропускает закрытые месяцы и сразу начинает с мелких окон, и его цифры
+    несопоставимы с первым запуском. В рабочей базе то же самое заставило бы следующий запуск ETL
+    заново загрузить всю историю, поэтому очистка выполняется только в базе, прошедшей bench_database_error.
+    """
+    with get_engine().begin() as conn:
+        connected_db = conn.execute(text("SELECT current_database()")).scalar()
+        if connected_db != db_name:
+            raise RuntimeError(f"очистка состояния синхронизации: ожидалась база бенчмарка {db_name}, подключена {connected_db}")
+        conn.execute(text("TRUNCATE sync_windows, transaction_window_sizes"))
+
+
+def run_benchmark(db_name, transactions_per_month, projects, latency_ms, seed, use_async=False):
+    """Выполнить полную синхронизацию против mock API в базе бенчмарка db_name и вернуть результаты по этапам"""
+    server = start_mock_server(
+        transactions_per_month=transactions_per_month, projects=projects, seed=seed, latency_ms=latency_ms
+    )
+    os.environ['SELECTEL_API_BASE_URL'] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault('SELECTEL_API_TOKEN', 'benchmark')
+
+    from selectel_etl import SelectelETL
+    if use_async:
+        from async_etl import AsyncSelectelETL as etl_class
+    else:
+        etl_class = SelectelETL
+    etl_class.ledger_class = BenchmarkLedger
+
+    etl = None
+    try:
+        etl = etl_class()
+        reset_sync_progress(db_name)
+        event.listen(Engine, 'before_cursor_execute', statement_counter)
+        tracemalloc.start()
+        started = time.monotonic()
+        etl.run_etl(full_sync=True)
+        wall_time = time.monotonic() - started
+        tracemalloc.stop()
+        event.remove(Engine, 'before_cursor_execute', statement_counter)
+    finally:
+        if etl is not None:
+            etl.close()
+        server.shutdown()
+
+    ledger = etl.ledger
+    stages = []
+    for record in ledger.records:
+        measurement = ledger.measurements.get(record['stage'], {})
+        stages.append({
+            'stage': record['stage'],
+            'status': record['status'],
+            'seconds': round(record['duration_seconds'], 3),
+            'api_calls': record['http_requests'],
+            'db_statements': measurement.get('db_statements'),
+            'peak_memory_mb': round(measurement.get('peak_memory_mb', 0.0), 2),
+            'rows': record['rows_inserted'] + record['rows_updated'] + record['rows_unchanged']
+        })
+    return {
+        'mode': 'async' if use_async else 'sync',
+        'transactions_per_month': transactions_per_month,
+        'projects': projects,
+        'latency_ms': latency_ms,
+        'wall_seconds': round(wall_time, 3),
+        'stages': stages
+    }
+
+
+def print_report(result):
+    """Вывести результаты бенчмарка таблицей"""
+    print(
+        f"\n📊 Бенчмарк ETL ({result['mode']}): {result['transactions_per_month']} транзакций/мес, "
+        f"{result['projects']} проектов, задержка API {result['latency_ms']} мс"
+    )
+    print(f"{'этап':<16}{'статус':<9}{'время, с':>10}{'API':>8}{'SQL':>8}{'память, МБ':>12}{'строк':>10}")
+    for stage in result['stages']:
+        # В асинхронном режиме этапы идут одновременно, SQL и память по этапам не разделяются
+        statements = stage['db_statements'] if result['mode'] == 'sync' else '-'
+        memory = f"{stage['peak_memory_mb']:.2f}" if result['mode'] == 'sync' else '-'
+        print(
+            f"{stage['stage']:<16}{stage['status']:<9}{stage['seconds']:>10.2f}{stage['api_calls']:>8}"
+            f"{statements:>8}{memory:>12}{stage['rows']:>10}"
+        )
+    print(f"Всего: {result['wall_seconds']:.2f} с")
+
+
+def _legacy_parse_transaction(transaction_data):
+    """Прежний разбор транзакции в словарь на строку (эталон для сравнения)"""
+    id_list = transaction_data.get('id_meta', {}).get('id', [])
+    if not id_list or not isinstance(id_list, list) or len(id_list) == 0:
+        return None
+    service_name = operation = service = None
+    server_meta = transaction_data.get('server_meta', {})
+    if isinstance(server_meta, dict) and 'en' in server_meta:
+        en_meta = server_meta['en']
+        service_name = en_meta.get('full_name')
+        operation = en_meta.get('operation')
+        service = en_meta.get('service')
+    created_str = transaction_data.get('created')
+    created_date = None
+    if created_str:
+        created_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
+    return {
+        'id': min(id_list),
+        'transaction_type': transaction_data.get('transaction_type'),
+        'transaction_group': transaction_data.get('transaction_group'),
+        'balance': transaction_data.get('balance'),
+        'price': float(transaction_data.get('price', 0)),
+        'state': transaction_data.get('state'),
+        'created': created_date,
+        'service_name': service_name,
+        'operation': operation,
+        'service': service,
+        'raw_data': transaction_data,
+        'fetched_at': datetime.utcnow()
+    }
+
+
+def _measure(func, items, repeat):
+    """Лучшее время из repeat прогонов и пиковая память одного прогона"""
+    best = float('inf')
+    for _ in range(repeat):
+        # Как в timeit: сборка мусора во время замера искажает сравнение
+        gc.disable()
+        started = time.perf_counter()
+        func(items)
+        best = min(best, time.perf_counter() - started)
+        gc.enable()
+    tracemalloc.start()
+    result = func(items)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return best, peak
+
+
+def benchmark_parsing(count, repeat=5):
+    """Сравнить прежний разбор (dict на строку) с TransactionRecord, включая подготовку параметров INSERT"""
+    data = MockBillingData(transactions_per_month=count)
+    items = list(data.transactions(datetime(2025, 1, 1), datetime(2025, 2, 1)))
+
+    def legacy(items):
+        rows = [row for row in map(_legacy_parse_transaction, items) if row is not None]
+        for row in rows:
+            row['raw_data'] = None
+            row['raw_payload_hash'] = None
+        return rows
+
+    def records(items):
+        records = parse_transactions(items)
+        return transaction_params(records, [None] * len(records), [None] * len(records), datetime.utcnow())
+
+    def records_only(items):
+        return parse_transactions(items)
+
+    print(f"\n📊 Разбор {len(items)} транзакций (лучшее из {repeat} прогонов)")
+    print(f"{'вариант':<32}{'время, мс':>12}{'мкс/строку':>12}{'память, МБ':>12}")
+    results = {}
+    for name, func in (('dict на строку (прежний)', legacy),
+                       ('TransactionRecord', records_only),
+                       ('TransactionRecord + параметры', records)):
+        seconds, peak = _measure(func, items, repeat)
+        results[name] = {'seconds': seconds, 'peak_memory_mb': peak / 1024 / 1024}
+        print(f"{name:<32}{seconds * 1000:>12.1f}{seconds / len(items) * 1e6:>12.2f}{peak / 1024 / 1024:>12.2f}")
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Бенчмарк Selectel Billing ETL на mock API')
+    parser.add_argument('--transactions-per-month', type=int, default=2000)
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Искусственная задержка ответов mock API, мс')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Запустить асинхронный движок')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='Лимит запросов в секунду (по умолчанию без ограничения, HTTP_RATE_LIMIT_RPS игнорируется)')
+    parser.add_argument('--json', dest='json_path', help='Сохранить результаты в JSON-файл для сравнения запусков')
+    parser.add_argument('--parse', type=int, metavar='N', help='Только микробенчмарк разбора N транзакций')
+    parser.add_argument('--db-name', default=os.getenv('BENCH_DB_NAME'),
+                        help='Отдельная база для бенчмарка (по умолчанию BENCH_DB_NAME); подключение - из DB_*')
+    parser.add_argument('--force', action='store_true', help='Запустить бенчмарк в базе, где уже есть транзакции')
+    args = parser.parse_args()
+
+    if args.parse:
+        benchmark_parsing(args.parse)
+        return 0
+
+    error = bench_database_error(args.db_name, args.force)
+    if error:
+        parser.error(error)
+
+    os.environ['HTTP_RATE_LIMIT_RPS'] = str(args.rate_limit)
+    result = run_benchmark(
+        args.db_name, args.transactions_per_month, args.projects, args.latency_ms, args.seed, args.use_async
+    )
+    print_report(result)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.json_path}")
+
+    return 0 if all(stage['status'] == 'success' for stage in result['stages']) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
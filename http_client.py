@@ -0,0 +1,282 @@
+"""
+HTTP-клиент Selectel API: пул keep-alive соединений, повторы с backoff и статистика по эндпоинтам
+"""
+
+import bisect
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import ijson
+import requests
+from requests.adapters import HTTPAdapter
+from loguru import logger
+from metrics import Counter, Histogram
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Границы корзин гистограммы задержек запросов, с
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+API_REQUEST_SECONDS = Histogram(
+    'selectel_api_request_duration_seconds', 'Длительность запросов к Selectel API', ('endpoint',), LATENCY_BUCKETS
+)
+API_REQUEST_ERRORS = Counter('selectel_api_request_errors_total', 'Запросы к API с сетевой ошибкой или кодом 4xx/5xx', ('endpoint',))
+API_RETRIES = Counter('selectel_api_retries_total', 'Повторы запросов к API', ('endpoint',))
+API_FAILURES = Counter('selectel_api_failures_total', 'Запросы к API, неудачные после всех повторов', ('endpoint',))
+
+# События ijson со скалярными значениями
+JSON_SCALAR_EVENTS = {'null', 'boolean', 'integer', 'double', 'number', 'string'}
+
+
+class JSONItemCollector:
+    """Собирает элементы массива prefix из событий ijson.parse, скаляры верхнего уровня кладет в meta"""
+    # В памяти держится только элемент, который разбирается в данный момент
+
+    def __init__(self, prefix, meta):
+        self.item_prefix = f"{prefix}.item"
+        self.meta = meta
+        self._builder = None
+        self._depth = 0
+
+    def feed(self, path, event, value):
+        """Обработать событие; вернуть (True, элемент), когда элемент разобран целиком"""
+        if self._builder is not None:
+            self._builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                self._depth += 1
+            elif event in ('end_map', 'end_array'):
+                self._depth -= 1
+                if self._depth == 0:
+                    item, self._builder = self._builder.value, None
+                    return True, item
+            return False, None
+
+        if path == self.item_prefix:
+            if event in ('start_map', 'start_array'):
+                self._builder = ijson.ObjectBuilder()
+                self._builder.event(event, value)
+                self._depth = 1
+            elif event in JSON_SCALAR_EVENTS:
+                return True, value
+        elif path and '.' not in path and event in JSON_SCALAR_EVENTS:
+            self.meta[path] = value
+        return False, None
+
+
+class RetryPolicy:
+    def __init__(self):
+        self.timeout = float(os.getenv('HTTP_TIMEOUT', 30))
+        self.max_retries = int(os.getenv('HTTP_MAX_RETRIES', 3))
+        self.backoff_base = float(os.getenv('HTTP_BACKOFF_BASE', 1.0))
+        self.backoff_max = float(os.getenv('HTTP_BACKOFF_MAX', 30))
+        # Верхняя граница ожидания по Retry-After: сервер может попросить подождать дольше, чем разумно ждать
+        self.retry_after_max = float(os.getenv('HTTP_RETRY_AFTER_MAX', 300))
+
+    def backoff_delay(self, attempt):
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def retry_after(self, headers):
+        """Задержка из заголовка Retry-After (секунды или HTTP-дата), если он есть"""
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            # HTTP-дата всегда в GMT; дата без зоны (или с -0000) разбирается как naive
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        if math.isnan(delay):
+            return None
+        delay = max(delay, 0.0)
+        if delay > self.retry_after_max:
+            logger.warning(
+                f"Retry-After {delay:.0f} с больше HTTP_RETRY_AFTER_MAX, повтор через {self.retry_after_max:.0f} с"
+            )
+            return self.retry_after_max
+        return delay
+
+    def retry_delay(self, status_code, headers, attempt):
+        """Задержка перед повтором ответа с кодом status_code или None, если повторять не нужно"""
+        if status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+            return None
+        delay = self.retry_after(headers)
+        return delay if delay is not None else self.backoff_delay(attempt)
+
+
+class RateLimiter:
+    def __init__(self):
+        # Общий для всех потоков лимит запросов в секунду (0 - без ограничения)
+        rate_limit = float(os.getenv('HTTP_RATE_LIMIT_RPS', 0))
+        self._min_interval = 1.0 / rate_limit if rate_limit > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Занять следующий слот и вернуть, сколько секунд до него ждать"""
+        if self._min_interval <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._min_interval
+        return slot - now
+
+
+class RequestStats:
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _endpoint_stats(self, endpoint):
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            stats = self._stats[endpoint] = {
+                'requests': 0,
+                'errors': 0,
+                'retries': 0,
+                'failures': 0,
+                'bytes': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+                # Количество запросов по корзинам LATENCY_BUCKETS, последняя - больше всех границ
+                'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)
+            }
+        return stats
+
+    def record(self, endpoint, elapsed, size, error=False):
+        with self._lock:
+            stats = self._endpoint_stats(endpoint)
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            stats['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            if error:
+                stats['errors'] += 1
+        API_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        if error:
+            API_REQUEST_ERRORS.inc(endpoint=endpoint)
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self._endpoint_stats(endpoint)['retries'] += 1
+        API_RETRIES.inc(endpoint=endpoint)
+
+    def record_failure(self, endpoint):
+        """Учесть запрос, завершившийся ошибкой после всех повторов"""
+        with self._lock:
+            self._endpoint_stats(endpoint)['failures'] += 1
+        API_FAILURES.inc(endpoint=endpoint)
+
+    def snapshot(self):
+        """Снимок статистики запросов по эндпоинтам"""
+        with self._lock:
+            return {
+                endpoint: dict(stats, latency_buckets=list(stats['latency_buckets']))
+                for endpoint, stats in self._stats.items()
+            }
+
+    def reset(self):
+        """Обнулить статистику запросов"""
+        with self._lock:
+            self._stats = {}
+
+    def log(self):
+        """Записать в лог задержки и количество повторов по каждому эндпоинту"""
+        for endpoint, stats in sorted(self.snapshot().items()):
+            avg = stats['total_seconds'] / stats['requests'] if stats['requests'] else 0.0
+            logger.info(
+                f"API {endpoint}: {stats['requests']} запросов, {stats['retries']} повторов, "
+                f"{stats['errors']} ошибок, {stats['failures']} неудачных, {stats['bytes'] / 1024:.1f} КБ, "
+                f"среднее {avg:.2f} с, максимум {stats['max_seconds']:.2f} с, всего {stats['total_seconds']:.2f} с"
+            )
+
+
+class SelectelHTTPClient:
+    def __init__(self, base_url, headers):
+        self.base_url = base_url
+        self.policy = RetryPolicy()
+        self.rate_limiter = RateLimiter()
+        self.stats = RequestStats()
+        pool_size = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        # Повторы делаем сами, чтобы учитывать их в статистике
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_json(self, endpoint, params=None):
+        """Выполнить GET-запрос с повторами и вернуть разобранный JSON"""
+        return self._send(endpoint, params).json()
+
+    def iter_json_items(self, endpoint, params=None, prefix='data', meta=None):
+        """Выполнить GET-запрос с повторами и потоково разобрать элементы массива prefix из ответа"""
+        # Тело не загружается целиком: элементы разбираются по мере чтения из сокета,
+        # скалярные поля верхнего уровня (например, status) попадают в meta
+        response = self._send(endpoint, params, stream=True)
+        collector = JSONItemCollector(prefix, meta if meta is not None else {})
+        try:
+            response.raw.decode_content = True
+            for path, event, value in ijson.parse(response.raw, use_float=True):
+                done, item = collector.feed(path, event, value)
+                if done:
+                    yield item
+        finally:
+            response.close()
+
+    def _send(self, endpoint, params=None, stream=False):
+        """Выполнить GET-запрос с повторами и вернуть успешный ответ"""
+        url = f"{self.base_url}{endpoint}"
+        attempt = 0
+
+        while True:
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                time.sleep(wait)
+
+            started = time.monotonic()
+            try:
+                response = self.session.get(url, params=params, timeout=self.policy.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.stats.record(endpoint, time.monotonic() - started, 0, error=True)
+                if attempt >= self.policy.max_retries:
+                    self.stats.record_failure(endpoint)
+                    raise
+                delay = self.policy.backoff_delay(attempt)
+                logger.warning(f"Сетевая ошибка при запросе к {url}: {e}. Повтор через {delay:.1f} с")
+            else:
+                # При потоковом чтении тело еще не получено, учитываем размер из заголовка
+                size = int(response.headers.get('Content-Length', 0)) if stream else len(response.content)
+                self.stats.record(endpoint, time.monotonic() - started, size, error=not response.ok)
+                delay = self.policy.retry_delay(response.status_code, response.headers, attempt)
+                if delay is None:
+                    if not response.ok:
+                        self.stats.record_failure(endpoint)
+                        response.close()
+                    response.raise_for_status()
+                    return response
+                response.close()
+                logger.warning(f"Ответ {response.status_code} от {url}. Повтор через {delay:.1f} с")
+
+            attempt += 1
+            self.stats.record_retry(endpoint)
+            time.sleep(delay)
+
+    def close(self):
+        """Закрыть пул соединений"""
+        self.session.close()
@@ -0,0 +1,439 @@
+"""
+Пакетная загрузка данных ETL в PostgreSQL
+"""
+
+import io
+import os
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import func, literal_column, select, text, tuple_
+from sqlalchemy.dialects.postgresql import array, insert
+from metrics import Histogram
+from models import (
+    Balance, LatestSnapshot, MonthlyServiceSpend, Prediction, ProjectReport, SyncState, SyncWindow, Transaction,
+    TransactionWindowSize
+)
+from raw_payloads import archive_payloads, archive_raw_data, payload_hash
+
+# Количество строк в одном INSERT ... ON CONFLICT
+UPSERT_BATCH_SIZE = int(os.getenv('ETL_UPSERT_BATCH_SIZE', 500))
+
+# Границы корзин гистограммы длительности SQL-операций загрузки, с
+DB_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DB_UPSERT_SECONDS = Histogram(
+    'selectel_etl_db_upsert_duration_seconds', 'Длительность пакетной записи в таблицу', ('table',), DB_LATENCY_BUCKETS
+)
+
+TRANSACTION_UPDATE_COLUMNS = [column.name for column in Transaction.__table__.columns if column.name != 'id']
+# Позиция created в строке transaction_params
+TRANSACTION_CREATED_INDEX = [column.name for column in Transaction.__table__.columns].index('created')
+
+# Первичный ключ transactions: (id) у старой таблицы или (id, created) у секционированной.
+# Upsert ссылается на ограничение по имени, поэтому работает с обеими схемами
+TRANSACTIONS_PKEY = 'transactions_pkey'
+
+# Ступени адаптивного дробления окна транзакций, от крупной к мелкой
+WINDOW_GRANULARITIES = ('month', 'week', 'day', 'hour')
+
+# Колонки project_reports, из которых считается content_hash строки отчета
+PROJECT_REPORT_CONTENT_COLUMNS = ('year', 'month', 'project_name', 'balance_type', 'value')
+
+
+def _batches(rows, batch_size):
+    """Разбить список строк на пачки фиксированного размера"""
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+def save_balances(session, rows):
+    """Сохранить снимок балансов и сделать его текущим, вернуть количество записей"""
+    archive_raw_data(session, 'balances', rows)
+    return _save_snapshot(session, 'balances', Balance, rows)
+
+
+def save_predictions(session, rows):
+    """Сохранить снимок прогнозов и сделать его текущим, вернуть количество записей"""
+    archive_raw_data(session, 'predictions', rows)
+    return _save_snapshot(session, 'predictions', Prediction, rows)
+
+
+def _save_snapshot(session, stream, model, rows):
+    """Записать строки снимка с общим snapshot_id и передвинуть указатель latest_snapshots"""
+    if not rows:
+        return 0
+    
+    snapshot_id = uuid.uuid4().hex
+    fetched_at = datetime.utcnow()
+    for row in rows:
+        row['snapshot_id'] = snapshot_id
+        row['fetched_at'] = fetched_at
+    with DB_UPSERT_SECONDS.time(table=model.__tablename__):
+        session.execute(insert(model.__table__), rows)
+    
+    # Указатель не откатывается на более старый снимок при конкурирующих запусках
+    stmt = insert(LatestSnapshot.__table__).values(stream=stream, snapshot_id=snapshot_id, fetched_at=fetched_at)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['stream'],
+        set_={'snapshot_id': stmt.excluded.snapshot_id, 'fetched_at': stmt.excluded.fetched_at},
+        where=LatestSnapshot.__table__.c.fetched_at <= stmt.excluded.fetched_at
+    )
+    session.execute(stmt)
+    return len(rows)
+
+
+def transaction_params(records, hashes, content_hashes, fetched_at):
+    """Позиционные строки INSERT для TransactionRecord в порядке колонок таблицы transactions"""
+    # Поля записи до raw_data идут в том же порядке, что и колонки таблицы, поэтому
+    # строка собирается срезом кортежа без промежуточного словаря; исходный ответ
+    # хранится в архиве по хешу, а raw_data в таблице остается пустым
+    return [
+        record[:-1] + (None, hash_value, fetched_at, content_hash)
+        for record, hash_value, content_hash in zip(records, hashes, content_hashes)
+    ]
+
+
+def _count_upserted(results, total):
+    """Разложить признаки "вставлена" строк из RETURNING пачки на (новых, обновлено, без изменений)"""
+    inserted_count = sum(1 for inserted in results if inserted)
+    updated_count = len(results) - inserted_count
+    # Строки с тем же content_hash отсекаются условием WHERE и в RETURNING не попадают
+    return inserted_count, updated_count, total - len(results)
+
+
+def _existing_transaction_ids(session, batch):
+    """id транзакций пачки, которые уже есть в таблице (до upsert, в той же транзакции)"""
+    table = Transaction.__table__
+    keys = _transaction_keys(batch)
+    if not keys:
+        return set()
+    created = [key[1] for key in keys]
+    # Границы по created отсекают лишние секции, поиск внутри секции идет по первичному ключу
+    return set(session.execute(
+        select(table.c.id).where(
+            tuple_(table.c.id, table.c.created).in_(keys),
+            table.c.created.between(min(created), max(created))
+        )
+    ).scalars())
+
+
+def _transaction_keys(batch):
+    return [(row[0], row[TRANSACTION_CREATED_INDEX]) for row in batch if row[TRANSACTION_CREATED_INDEX] is not None]
+
+
+def _delete_moved_transactions(session, batch):
+    """Удалить прежние строки транзакций пачки, у которых API исправил created; вернуть [(id, прежний created)]"""
+    keys = _transaction_keys(batch)
+    if not keys:
+        return []
+    # Первичный ключ (id, created) не мешает вставить вторую строку с тем же id, поэтому старая строка
+    # удаляется явно. Прежний created может быть в любом месяце: id ищется во всех секциях
+    # Ключи передаются двумя массивами: IN/NOT IN по списку кортежей PostgreSQL планирует на порядок дольше
+    return session.execute(text("""
+        DELETE FROM transactions t
+        USING unnest(CAST(:ids AS integer[]), CAST(:created AS timestamp[])) AS s(id, created)
+        WHERE t.id = s.id AND t.created <> s.created
+        RETURNING t.id, t.created
+    """), {'ids': [key[0] for key in keys], 'created': [key[1] for key in keys]}).all()
+
+
+def _refresh_moved_rollups(session, moved_created):
+    """Пересчитать агрегаты расходов за дни, из которых ушли транзакции с исправленным created"""
+    moved_created = [created for created in moved_created if created is not None]
+    if moved_created:
+        refresh_spend_rollups(session, min(moved_created), max(moved_created))
+
+
+def upsert_transactions(session, records, batch_size=None):
+    """Вставить или обновить транзакции (TransactionRecord) пачками, вернуть (новых, обновлено, без изменений)"""
+    batch_size = batch_size or UPSERT_BATCH_SIZE
+    # Один INSERT не может дважды затронуть одну и ту же строку, поэтому
+    # дубликаты внутри страницы схлопываем, оставляя последнюю версию
+    unique_records = list({record.id: record for record in records}.values())
+    # Одинаковый порядок блокировок строк в параллельных потоках исключает взаимоблокировки
+    unique_records.sort(key=lambda record: record.id)
+    payloads = [record.raw_data for record in unique_records]
+    # Содержимое транзакции - канонический JSON ответа API; тот же хеш служит ключом архива
+    content_hashes = [payload_hash(payload) for payload in payloads]
+    hashes = archive_payloads(session, 'transactions', payloads, content_hashes)
+    rows = transaction_params(unique_records, hashes, content_hashes, datetime.utcnow())
+    
+    totals = [0, 0, 0]
+    moved_created = []
+    table = Transaction.__table__
+    for batch in _batches(rows, batch_size):
+        stmt = insert(table).values(batch)
+        stmt = stmt.on_conflict_do_update(
+            constraint=TRANSACTIONS_PKEY,
+            set_={name: stmt.excluded[name] for name in TRANSACTION_UPDATE_COLUMNS},
+            # Неизменная транзакция не перезаписывается: ни новой версии строки, ни WAL
+            where=table.c.content_hash.is_distinct_from(stmt.excluded.content_hash)
+        )
+        # Секционированная таблица не отдает xmax в RETURNING, поэтому вставленные строки
+        # определяются по id, которых не было до upsert
+        stmt = stmt.returning(table.c.id)
+        
+        with DB_UPSERT_SECONDS.time(table='transactions'):
+            moved = _delete_moved_transactions(session, batch)
+            # Транзакция с исправленным created считается обновленной, а не новой
+            existing = _existing_transaction_ids(session, batch) | {row_id for row_id, _ in moved}
+            returned = session.execute(stmt).scalars().all()
+        moved_created += [created for _, created in moved]
+        results = [row_id not in existing for row_id in returned]
+        totals = [total + count for total, count in zip(totals, _count_upserted(results, len(batch)))]
+    
+    _refresh_moved_rollups(session, moved_created)
+    return tuple(totals)
+
+
+def upsert_project_reports(session, rows, batch_size=None):
+    """Вставить или обновить строки отчета по проектам пачками, вернуть (новых, обновлено, без изменений)"""
+    batch_size = batch_size or UPSERT_BATCH_SIZE
+    unique_rows = list({_project_report_key(row): row for row in rows}.values())
+    unique_rows.sort(key=_project_report_key)
+    for row in unique_rows:
+        # raw_data общий для всех строк проекта, поэтому хешируются только значения самой строки
+        row['content_hash'] = payload_hash({name: row[name] for name in PROJECT_REPORT_CONTENT_COLUMNS})
+    archive_raw_data(session, 'project_reports', unique_rows)
+    
+    totals = [0, 0, 0]
+    table = ProjectReport.__table__
+    for batch in _batches(unique_rows, batch_size):
+        stmt = insert(table).values(batch)
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_project_reports_period',
+            set_={
+                'value': stmt.excluded.value,
+                'raw_data': stmt.excluded.raw_data,
+                'raw_payload_hash': stmt.excluded.raw_payload_hash,
+                'fetched_at': stmt.excluded.fetched_at,
+                'content_hash': stmt.excluded.content_hash
+            },
+            where=table.c.content_hash.is_distinct_from(stmt.excluded.content_hash)
+        )
+        stmt = stmt.returning(literal_column('(xmax = 0)').label('inserted'))
+        
+        with DB_UPSERT_SECONDS.time(table='project_reports'):
+            results = session.execute(stmt).scalars().all()
+        totals = [total + count for total, count in zip(totals, _count_upserted(results, len(batch)))]
+    
+    return tuple(totals)
+
+
+def _project_report_key(row):
+    return row['year'], row['month'], row['project_name'], row['balance_type']
+
+
+# Колонки transactions, которые заполняются при загрузке через COPY (raw_data остается пустым)
+STAGE_COLUMNS = [column.name for column in Transaction.__table__.columns if column.name != 'raw_data']
+
+# Экранирование значений для текстового формата COPY
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def create_transactions_stage(session):
+    """Создать временную таблицу transactions_stage для загрузки через COPY (удаляется при COMMIT)"""
+    # created - timestamptz, как и параметры psycopg2 для дат с часовым поясом: при слиянии
+    # значение приводится к timestamp так же, как при обычном INSERT
+    session.execute(text("""
+        CREATE TEMP TABLE transactions_stage (
+            seq BIGSERIAL,
+            id BIGINT NOT NULL,
+            transaction_type VARCHAR(50),
+            transaction_group VARCHAR(50),
+            balance VARCHAR(50),
+            price DOUBLE PRECISION,
+            state VARCHAR(50),
+            created TIMESTAMPTZ,
+            service_name TEXT,
+            operation TEXT,
+            service TEXT,
+            raw_payload_hash VARCHAR(64),
+            fetched_at TIMESTAMP,
+            content_hash VARCHAR(64)
+        ) ON COMMIT DROP
+    """))
+
+
+def copy_transactions(session, records):
+    """Загрузить TransactionRecord во временную таблицу через COPY FROM STDIN, вернуть количество строк"""
+    if not records:
+        return 0
+    payloads = [record.raw_data for record in records]
+    content_hashes = [payload_hash(payload) for payload in payloads]
+    hashes = archive_payloads(session, 'transactions', payloads, content_hashes)
+    fetched_at = datetime.utcnow()
+    
+    buffer = io.StringIO()
+    for record, hash_value, content_hash in zip(records, hashes, content_hashes):
+        values = record[:-1] + (hash_value, fetched_at, content_hash)
+        buffer.write('\t'.join(map(_copy_value, values)))
+        buffer.write('\n')
+    buffer.seek(0)
+    
+    # COPY выполняется на том же соединении и в той же транзакции, что и сессия
+    cursor = session.connection().connection.cursor()
+    try:
+        with DB_UPSERT_SECONDS.time(table='transactions_stage'):
+            cursor.copy_expert(f"COPY transactions_stage ({', '.join(STAGE_COLUMNS)}) FROM STDIN", buffer)
+    finally:
+        cursor.close()
+    return len(records)
+
+
+def merge_transactions_stage(session):
+    """Перенести transactions_stage в transactions одним upsert, вернуть (новых, обновлено, без изменений)"""
+    columns = ', '.join(STAGE_COLUMNS)
+    updates = ', '.join(f"{name} = EXCLUDED.{name}" for name in TRANSACTION_UPDATE_COLUMNS)
+    # Повторы одной транзакции на разных страницах схлопываем, оставляя последнюю версию
+    with DB_UPSERT_SECONDS.time(table='transactions'):
+        # Секционированная таблица не отдает xmax в RETURNING: все CTE видят один снимок,
+        # поэтому existing - строки, которые были в таблице до вставки.
+        # moved - прежние строки транзакций, у которых API исправил created (см. _delete_moved_transactions);
+        # новая строка с другим created не конфликтует с удаляемой, поэтому обе операции - в одном запросе
+        inserted, updated, unchanged, moved_from, moved_to = session.execute(text(f"""
+            WITH source AS (
+                SELECT DISTINCT ON (id) {columns}
+                FROM transactions_stage
+                ORDER BY id, seq DESC
+            ), existing AS (
+                SELECT t.id FROM transactions t JOIN source s ON t.id = s.id AND t.created = s.created
+            ), moved AS (
+                DELETE FROM transactions t
+                USING source s
+                WHERE t.id = s.id AND t.created IS DISTINCT FROM s.created AND s.created IS NOT NULL
+                RETURNING t.id, t.created
+            ), merged AS (
+                INSERT INTO transactions ({columns})
+                SELECT {columns} FROM source
+                ON CONFLICT ON CONSTRAINT {TRANSACTIONS_PKEY} DO UPDATE SET {updates}
+                WHERE transactions.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+                RETURNING id
+            )
+            SELECT COUNT(*) FILTER (WHERE id NOT IN (SELECT id FROM existing UNION ALL SELECT id FROM moved)),
+                   COUNT(*) FILTER (WHERE id IN (SELECT id FROM existing UNION ALL SELECT id FROM moved)),
+                   (SELECT COUNT(*) FROM source) - COUNT(*),
+                   (SELECT MIN(created) FROM moved),
+                   (SELECT MAX(created) FROM moved)
+            FROM merged
+        """)).one()
+    _refresh_moved_rollups(session, [moved_from, moved_to])
+    return inserted, updated, unchanged
+
+
+def refresh_spend_rollups(session, start_date, end_date):
+    """Пересчитать дневные и месячные агрегаты расходов за дни/месяцы, затронутые периодом"""
+    # Параллельные запуски ETL не должны пересчитывать агрегаты одновременно
+    session.execute(text("SELECT pg_advisory_xact_lock(hashtext('service_spend_rollups'))"))
+    
+    # Первый запуск: агрегатов еще нет, строим их по всей истории транзакций
+    if session.execute(select(MonthlyServiceSpend.month).limit(1)).first() is None:
+        first_created = session.execute(select(func.min(Transaction.created))).scalar()
+        if first_created is not None:
+            start_date = min(start_date, first_created)
+    
+    day_from = start_date.date()
+    day_to = end_date.date() + timedelta(days=1)
+    month_from = day_from.replace(day=1)
+    month_to = (day_to.replace(day=1) + timedelta(days=32)).replace(day=1) if day_to.day > 1 else day_to
+    
+    params = {'day_from': day_from, 'day_to': day_to, 'month_from': month_from, 'month_to': month_to}
+    session.execute(text("DELETE FROM daily_service_spend WHERE day >= :day_from AND day < :day_to"), params)
+    session.execute(text("""
+        INSERT INTO daily_service_spend (day, service, balance, total_spent, transactions_count, updated_at)
+        SELECT created::date, COALESCE(service, ''), balance, SUM(ABS(price)), COUNT(*), now()
+        FROM transactions
+        WHERE price < 0 AND created >= :day_from AND created < :day_to
+        GROUP BY 1, 2, 3
+    """), params)
+    session.execute(text("DELETE FROM monthly_service_spend WHERE month >= :month_from AND month < :month_to"), params)
+    session.execute(text("""
+        INSERT INTO monthly_service_spend (month, service, balance, total_spent, transactions_count, updated_at)
+        SELECT DATE_TRUNC('month', created)::date, COALESCE(service, ''), balance, SUM(ABS(price)), COUNT(*), now()
+        FROM transactions
+        WHERE price < 0 AND created >= :month_from AND created < :month_to
+        GROUP BY 1, 2, 3
+    """), params)
+
+
+def get_sync_cursor(session, stream):
+    """Получить водяной знак (created_to последней успешной синхронизации) потока"""
+    return session.execute(
+        select(SyncState.cursor).where(SyncState.stream == stream)
+    ).scalar_one_or_none()
+
+
+def advance_sync_cursor(session, stream, cursor):
+    """Сдвинуть водяной знак потока вперед (назад он никогда не откатывается)"""
+    stmt = insert(SyncState.__table__).values(stream=stream, cursor=cursor, updated_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['stream'],
+        set_={
+            'cursor': func.greatest(SyncState.__table__.c.cursor, stmt.excluded.cursor),
+            'updated_at': stmt.excluded.updated_at
+        }
+    )
+    session.execute(stmt)
+
+
+def get_completed_windows(session, stream, start_date, end_date):
+    """Начала окон потока, которые уже загружены после закрытия и не требуют повторного запроса"""
+    return set(session.execute(
+        select(SyncWindow.window_start).where(
+            SyncWindow.stream == stream,
+            SyncWindow.window_start >= start_date,
+            SyncWindow.window_start < end_date
+        )
+    ).scalars())
+
+
+def mark_windows_completed(session, stream, windows):
+    """Отметить закрытые окна потока [(start, end, строк)] как загруженные"""
+    if not windows:
+        return
+    stmt = insert(SyncWindow.__table__).values([
+        {'stream': stream, 'window_start': start, 'window_end': end, 'rows': rows, 'completed_at': datetime.utcnow()}
+        for start, end, rows in windows
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['stream', 'window_start'],
+        set_={'window_end': stmt.excluded.window_end, 'rows': stmt.excluded.rows, 'completed_at': stmt.excluded.completed_at}
+    )
+    session.execute(stmt)
+
+
+def get_window_granularities(session, start_date, end_date):
+    """Сохраненная гранулярность окон транзакций {начало месяца: month/week/day/hour} за период"""
+    return dict(session.execute(
+        select(TransactionWindowSize.month, TransactionWindowSize.granularity).where(
+            TransactionWindowSize.month >= start_date,
+            TransactionWindowSize.month < end_date
+        )
+    ).all())
+
+
+def save_window_granularities(session, granularities):
+    """Запомнить гранулярность окон транзакций {начало месяца: month/week/day/hour}; сохраненная только мельчает"""
+    if not granularities:
+        return
+    table = TransactionWindowSize.__table__
+    stmt = insert(table).values([
+        {'month': month, 'granularity': granularity, 'updated_at': datetime.utcnow()}
+        for month, granularity in granularities.items()
+    ])
+    # Параллельный или более поздний запуск с крупным окном не затирает уже найденное мелкое дробление
+    order = array(WINDOW_GRANULARITIES)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['month'],
+        set_={'granularity': stmt.excluded.granularity, 'updated_at': stmt.excluded.updated_at},
+        where=func.array_position(order, stmt.excluded.granularity) > func.array_position(order, table.c.granularity)
+    )
+    session.execute(stmt)
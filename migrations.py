@@ -0,0 +1,216 @@
+"""
+Версионированные миграции схемы БД: применяются по порядку, версия хранится в schema_version
+
+Миграция 1 создает таблицы по текущим моделям, поэтому на новой базе последующие шаги
+должны быть идемпотентными (IF NOT EXISTS и т.п.). Новый шаг добавляется в конец MIGRATIONS.
+"""
+
+import re
+from datetime import datetime
+from typing import Callable, NamedTuple
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.schema import CreateIndex
+from models import Base, SchemaVersion, get_engine
+from partitions import create_upcoming_partitions
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable
+    # CREATE INDEX CONCURRENTLY не работает внутри транзакции: такой шаг получает соединение в AUTOCOMMIT
+    transactional: bool = True
+
+
+def _create_tables(conn):
+    """Создать таблицы моделей, которых еще нет в базе"""
+    Base.metadata.create_all(conn)
+
+
+def _legacy_columns(conn):
+    """Колонки и таблицы, которые раньше проверялись при каждом запуске через information_schema"""
+    # Добавляем колонку balance_type в balances, если её нет
+    conn.execute(text("ALTER TABLE balances ADD COLUMN IF NOT EXISTS balance_type VARCHAR(50)"))
+
+    # Миграция для таблицы predictions: удаляем старые колонки и добавляем новые
+    conn.execute(text("""
+        DO $$
+        BEGIN
+            -- Проверяем, нужна ли миграция (если есть старая колонка period_start)
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name='predictions' AND column_name='period_start'
+            ) THEN
+                -- Удаляем данные из старой таблицы
+                DELETE FROM predictions;
+
+                -- Удаляем старые колонки
+                ALTER TABLE predictions DROP COLUMN IF EXISTS period_start;
+                ALTER TABLE predictions DROP COLUMN IF EXISTS period_end;
+                ALTER TABLE predictions DROP COLUMN IF EXISTS confidence_level;
+                ALTER TABLE predictions DROP COLUMN IF EXISTS currency;
+
+                -- Добавляем новую колонку balance_type, если её нет
+                ALTER TABLE predictions ADD COLUMN IF NOT EXISTS balance_type VARCHAR(50) NOT NULL DEFAULT 'primary';
+            END IF;
+        END$$;
+    """))
+
+    # Удаление таблицы summary_stats (статистика по проектам больше не нужна)
+    conn.execute(text("DROP TABLE IF EXISTS summary_stats"))
+
+    # Добавление новых колонок в таблицу transactions
+    conn.execute(text("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS operation VARCHAR(255)"))
+    conn.execute(text("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS service VARCHAR(255)"))
+
+    # Переименование колонки account_id в balance_id в таблице balances
+    conn.execute(text("""
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name='balances' AND column_name='account_id'
+            ) THEN
+                ALTER TABLE balances RENAME COLUMN account_id TO balance_id;
+            END IF;
+        END$$;
+    """))
+
+
+def _raw_payload_columns(conn):
+    """Ссылка на архив исходных ответов API и идентификатор снимка"""
+    # Ссылка на архив исходных ответов API вместо полного JSON в каждой строке
+    for table_name in ('balances', 'predictions', 'transactions', 'project_reports'):
+        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS raw_payload_hash VARCHAR(64)"))
+
+    # Идентификатор снимка для балансов и прогнозов
+    for table_name in ('balances', 'predictions'):
+        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS snapshot_id VARCHAR(32)"))
+
+
+def _content_hash_columns(conn):
+    """Хеш содержимого строки: upsert пропускает строки, которые не изменились"""
+    for table_name in ('transactions', 'project_reports'):
+        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)"))
+    conn.execute(text("ALTER TABLE etl_run_stages ADD COLUMN IF NOT EXISTS rows_unchanged INTEGER NOT NULL DEFAULT 0"))
+
+
+def _indexes(conn):
+    """Онлайн-миграция индексов и уникальных ограничений для уже существующих таблиц"""
+    constraint_exists = conn.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'uq_project_reports_period'"
+    )).scalar()
+    if not constraint_exists:
+        # Сначала удаляем дубликаты, оставляя самую свежую запись
+        conn.execute(text("""
+            DELETE FROM project_reports a
+            USING project_reports b
+            WHERE a.year = b.year
+              AND a.month = b.month
+              AND a.project_name = b.project_name
+              AND a.balance_type = b.balance_type
+              AND a.id < b.id
+        """))
+        _create_index_concurrently(
+            conn,
+            'uq_project_reports_period',
+            "CREATE UNIQUE INDEX CONCURRENTLY uq_project_reports_period "
+            "ON project_reports (year, month, project_name, balance_type)"
+        )
+        conn.execute(text(
+            "ALTER TABLE project_reports ADD CONSTRAINT uq_project_reports_period "
+            "UNIQUE USING INDEX uq_project_reports_period"
+        ))
+
+    # CONCURRENTLY не поддерживается для секционированных таблиц: индекс создается сразу на всех секциях
+    partitioned = set(conn.execute(text(
+        "SELECT c.relname FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid"
+    )).scalars())
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+            if table.name not in partitioned:
+                ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY', ddl)
+            _create_index_concurrently(conn, index.name, ddl)
+
+
+def _create_index_concurrently(conn, name, ddl):
+    """Создать индекс, если его нет; недостроенный после сбоя индекс пересоздается"""
+    valid = conn.execute(text("""
+        SELECT i.indisvalid
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.relname = :name
+    """), {'name': name}).scalar()
+    if valid:
+        return
+    if valid is not None:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    conn.execute(text(ddl))
+
+
+def _baseline(conn):
+    """Таблицы по моделям и поправки колонок, которые раньше выполнялись при каждом запуске"""
+    _create_tables(conn)
+    _legacy_columns(conn)
+
+
+def _initial_partitions(conn):
+    """Секции секционированных таблиц на текущий и ближайшие месяцы (дальше их создает каждый запуск ETL)"""
+    create_upcoming_partitions(conn)
+
+
+MIGRATIONS = [
+    Migration(1, 'таблицы по моделям и прежние поправки колонок', _baseline),
+    Migration(2, 'raw_payload_hash и snapshot_id', _raw_payload_columns),
+    Migration(3, 'content_hash и rows_unchanged', _content_hash_columns),
+    Migration(4, 'индексы и уникальный ключ project_reports', _indexes, transactional=False),
+    Migration(5, 'начальные помесячные секции', _initial_partitions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(engine):
+    """Текущая версия схемы (0 - база еще не размечена версиями); один запрос к БД"""
+    with engine.connect() as conn:
+        try:
+            return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+        except ProgrammingError:
+            # Таблицы schema_version еще нет: новая база или база до появления миграций
+            return 0
+
+
+def migrate(engine=None):
+    """Применить миграции, которые еще не применены; при актуальной схеме - один запрос"""
+    engine = engine or get_engine()
+    if current_version(engine) >= LATEST_VERSION:
+        return
+
+    with engine.connect() as lock_conn:
+        # Параллельные запуски (cron, планировщик) не применяют миграции одновременно
+        lock_conn.execute(text("SELECT pg_advisory_lock(hashtext('schema_migrations'))"))
+        lock_conn.commit()
+        try:
+            SchemaVersion.__table__.create(engine, checkfirst=True)
+            version = current_version(engine)
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                logger.info(f"Миграция схемы {migration.version}: {migration.description}")
+                record = SchemaVersion.__table__.insert().values(
+                    version=migration.version, description=migration.description, applied_at=datetime.utcnow()
+                )
+                if migration.transactional:
+                    # Шаг и отметка о нем фиксируются в одной транзакции
+                    with engine.begin() as conn:
+                        migration.apply(conn)
+                        conn.execute(record)
+                else:
+                    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                        migration.apply(conn)
+                        conn.execute(record)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(hashtext('schema_migrations'))"))
+            lock_conn.commit()
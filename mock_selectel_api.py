@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Локальная замена Selectel Billing API для офлайн-тестов и бенчмарков ETL
+
+Отдает четыре эндпоинта из swagger.yaml на сгенерированных данных заданного масштаба;
+данные детерминированы (зависят только от seed) и пагинация транзакций соблюдается.
+"""
+
+import bisect
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from loguru import logger
+
+SERVICES = [
+    ('Облачный сервер', 'Cloud server'),
+    ('Объектное S3 хранилище', 'Object S3 Storage'),
+    ('Выделенный сервер', 'Dedicated server'),
+    ('Управляемая база данных PostgreSQL', 'Managed PostgreSQL'),
+    ('Публичный IP', 'Public IP'),
+    ('Сетевой диск', 'Network volume'),
+    ('Балансировщик нагрузки', 'Load balancer'),
+    ('Managed Kubernetes', 'Managed Kubernetes'),
+    ('CDN', 'CDN'),
+    ('Резервное копирование', 'Backup'),
+    ('Файловое хранилище', 'File storage'),
+    ('Container Registry', 'Container Registry')
+]
+BALANCES = ['main', 'bonus', 'vk_rub']
+MAX_PAGE_SIZE = 500
+
+# Идентификаторы транзакций должны помещаться в transactions.id (INTEGER, до 2^31 - 1), как в реальном API (687288652):
+# начиная с 2000 года на месяц отводится MONTH_ID_STEP номеров
+TRANSACTION_ID_BASE = 600_000_000
+MONTH_ID_STEP = 1_000_000
+
+
+def _month_start(year, month):
+    return datetime(year, month, 1)
+
+
+def _next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _transaction_id(year, month, index):
+    """Уникальный идентификатор index-й транзакции месяца в диапазоне INTEGER"""
+    transaction_id = TRANSACTION_ID_BASE + ((year - 2000) * 12 + month - 1) * MONTH_ID_STEP + index
+    if not 0 < transaction_id < 2 ** 31:
+        raise ValueError(f"месяц {month}/{year} вне диапазона идентификаторов mock API")
+    return transaction_id
+
+
+class MockBillingData:
+    """Детерминированный генератор данных биллинга"""
+
+    def __init__(self, transactions_per_month=2000, projects=100, seed=42):
+        if transactions_per_month > MONTH_ID_STEP:
+            raise ValueError(f"не больше {MONTH_ID_STEP} транзакций в месяц")
+        self.transactions_per_month = transactions_per_month
+        self.projects = projects
+        self.seed = seed
+        self._transactions = {}
+        self._lock = threading.Lock()
+
+    def balances(self):
+        rng = random.Random(f"{self.seed}-balances")
+        return {
+            'billings': [{
+                'balances': [
+                    {'balance_id': str(10000 + index), 'balance_type': balance_type, 'value': rng.randint(0, 10_000_000)}
+                    for index, balance_type in enumerate(BALANCES)
+                ]
+            }]
+        }
+
+    def prediction(self):
+        rng = random.Random(f"{self.seed}-prediction")
+        return {'primary': round(rng.uniform(100, 5000), 2), 'storage': None, 'vmware': None, 'vpc': None}
+
+    def _month_transactions(self, year, month):
+        """Транзакции месяца, отсортированные по дате создания: (список дат, список транзакций)"""
+        key = (year, month)
+        with self._lock:
+            cached = self._transactions.get(key)
+        if cached is not None:
+            return cached
+
+        rng = random.Random(f"{self.seed}-transactions-{year}-{month}")
+        start = _month_start(year, month)
+        seconds = int((_month_start(*_next_month(year, month)) - start).total_seconds())
+        items = []
+        for index in range(self.transactions_per_month):
+            created = start + timedelta(seconds=rng.randrange(seconds), microseconds=rng.randrange(1_000_000))
+            service_ru, service_en = rng.choice(SERVICES)
+            deposit = rng.random() < 0.02
+            transaction_type = 'deposit' if deposit else 'withdraw'
+            items.append((created, {
+                'user_id': 56325,
+                'transaction_type': transaction_type,
+                'balance': rng.choice(BALANCES),
+                'dir': 'incoming' if deposit else 'outgoing',
+                'created': created.isoformat(),
+                'price': rng.randint(100_000, 5_000_000) if deposit else -rng.randint(1, 50_000),
+                'state': 'PAID',
+                'id_meta': {
+                    'id': [_transaction_id(year, month, index)],
+                    'billing': 'primary',
+                    'service_id': None,
+                    'service_name': service_ru,
+                    'service_name_en': service_en
+                },
+                'transaction_group': transaction_type,
+                'server_meta': {
+                    'ru': {'operation': 'Оплата услуги', 'service': service_ru, 'full_name': f"Оплата услуги {service_ru}"},
+                    'en': {'operation': 'Payment for service', 'service': service_en, 'full_name': f"Payment for service {service_en}"},
+                    'main_resource_uuid': '',
+                    'server_id': None,
+                    'equip_id': None,
+                    'service_id': None,
+                    'service_type': 21,
+                    'service_sub_type': 1
+                },
+                'reason_for_debt': None,
+                'date_payment_must_made': None,
+                'jurbrand_key': 'selectel_russia'
+            }))
+        items.sort(key=lambda item: (item[0], item[1]['id_meta']['id'][0]))
+        result = ([created for created, _ in items], [transaction for _, transaction in items])
+
+        with self._lock:
+            return self._transactions.setdefault(key, result)
+
+    def transactions(self, created_from, created_to, balances=None):
+        """Транзакции с created_from <= created < created_to в порядке создания"""
+        year, month = created_from.year, created_from.month
+        while _month_start(year, month) < created_to:
+            dates, items = self._month_transactions(year, month)
+            for position in range(bisect.bisect_left(dates, created_from), bisect.bisect_left(dates, created_to)):
+                if balances is None or items[position]['balance'] in balances:
+                    yield items[position]
+            year, month = _next_month(year, month)
+
+    def project_report(self, year, month):
+        rng = random.Random(f"{self.seed}-projects-{year}-{month}")
+        projects = []
+        for index in range(self.projects):
+            payments = [
+                {'balance': balance_type, 'value': rng.randint(0, 500_000)}
+                for balance_type in rng.sample(BALANCES, rng.randint(1, 2))
+            ]
+            value = sum(payment['value'] for payment in payments)
+            service_ru, service_en = rng.choice(SERVICES)
+            projects.append({
+                'id': f"{index:032x}",
+                'name': f"project-{index:04d}",
+                'paid_by_balance': payments,
+                'value': value,
+                'products': [{
+                    'id': 21,
+                    'name': service_en,
+                    'paid_by_balance': payments,
+                    'value': value,
+                    'objects': [{
+                        'id': f"{index:08x}-0000-0000-0000-000000000000",
+                        'name': service_ru,
+                        'type': 'server',
+                        'type_name': service_ru,
+                        'service_name': None,
+                        'paid_by_balance': payments,
+                        'value': value,
+                        'resources': [],
+                        'objects': []
+                    }]
+                }]
+            })
+        return {
+            'account_id': 56325,
+            'agreement_id': 0,
+            'locale': 'ru',
+            'project_ids': [],
+            'year': year,
+            'month': month,
+            'projects': projects,
+            'value': sum(project['value'] for project in projects),
+            'paid_by_balance': []
+        }
+
+
+class MockSelectelHandler(BaseHTTPRequestHandler):
+    # Атрибуты задаются в start_mock_server
+    data = None
+    latency = 0.0
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send_json(status, {'status': 'error', 'message': message})
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.headers.get('X-Token'):
+            self._error(401, 'Unauthorized')
+            return
+
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        handlers = {
+            '/v3/balances': self._balances,
+            '/v2/billing/prediction': self._prediction,
+            '/v2/billing/transactions': self._transactions,
+            '/v1/billing/report/by_project/detailed': self._project_report
+        }
+        handler = handlers.get(url.path)
+        if handler is None:
+            self._error(404, f"Unknown endpoint: {url.path}")
+            return
+        try:
+            handler(params)
+        except (KeyError, ValueError) as e:
+            self._error(400, f"Invalid parameters: {e}")
+
+    def _balances(self, params):
+        self._send_json(200, {'status': 'success', 'data': self.data.balances()})
+
+    def _prediction(self, params):
+        self._send_json(200, {'status': 'success', 'data': self.data.prediction()})
+
+    def _transactions(self, params):
+        if 'limit' not in params:
+            self._error(400, 'Missing required parameter: limit')
+            return
+        limit = min(int(params['limit']), MAX_PAGE_SIZE)
+        offset = int(params.get('offset', 0))
+        created_from = datetime.fromisoformat(params['created_from'])
+        created_to = datetime.fromisoformat(params['created_to'])
+        balances = set(params['balances'].split(',')) if params.get('balances') else None
+
+        page = list(itertools.islice(self.data.transactions(created_from, created_to, balances), offset, offset + limit))
+        self._send_json(200, {'status': 'success', 'data': page})
+
+    def _project_report(self, params):
+        year, month = int(params['year']), int(params['month'])
+        if not 1 <= month <= 12:
+            raise ValueError(f"month={month}")
+        self._send_json(200, {'status': 'success', 'data': self.data.project_report(year, month)})
+
+    def log_message(self, format, *args):
+        logger.debug(f"mock API: {format % args}")
+
+
+def start_mock_server(port=0, host='127.0.0.1', transactions_per_month=2000, projects=100, seed=42, latency_ms=0):
+    """Запустить mock API в фоновом потоке; адрес - server.server_address"""
+    handler = type('MockSelectelHandler', (MockSelectelHandler,), {
+        'data': MockBillingData(transactions_per_month, projects, seed),
+        'latency': latency_ms / 1000
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-selectel-api', daemon=True).start()
+    logger.info(
+        f"Mock Selectel API запущен на http://{host}:{server.server_address[1]} "
+        f"({transactions_per_month} транзакций/мес, {projects} проектов)"
+    )
+    return server
+
+
+def main():
+    """Запустить mock API в отдельном процессе"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mock Selectel Billing API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--transactions-per-month', type=int, default=2000)
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Искусственная задержка каждого ответа, мс')
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, args.host, args.transactions_per_month, args.projects, args.seed, args.latency_ms)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
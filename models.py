@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, JSON, text
+from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, Date, DateTime, Text, JSON, LargeBinary, ForeignKey, Index, UniqueConstraint, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -9,27 +9,47 @@ load_dotenv()
 
 Base = declarative_base()
 
+# Таблицы transactions, balances и predictions секционированы по месяцам (см. partitions.py),
+# поэтому ключ секционирования входит в первичный ключ
 class Balance(Base):
     __tablename__ = 'balances'
     
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     balance_id = Column(String(50), nullable=False)
     balance_type = Column(String(50))
     currency = Column(String(10), nullable=False)
     amount = Column(Float, nullable=False)
     credit_limit = Column(Float)
     status = Column(String(20))
-    raw_data = Column(JSON)
-    fetched_at = Column(DateTime, default=datetime.utcnow)
+    raw_data = Column(JSON(none_as_null=True))  # устарело: исходный ответ хранится в raw_payloads
+    raw_payload_hash = Column(String(64))  # ссылка на raw_payloads.hash
+    fetched_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    
+    snapshot_id = Column(String(32))  # идентификатор снимка (одного запроса к API)
+    
+    __table_args__ = (
+        Index('ix_balances_fetched_at', 'fetched_at'),
+        Index('ix_balances_snapshot_id', 'snapshot_id'),
+        {'postgresql_partition_by': 'RANGE (fetched_at)'},
+    )
 
 class Prediction(Base):
     __tablename__ = 'predictions'
     
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     balance_type = Column(String(50), nullable=False)  # primary, storage, vmware, vpc
     predicted_amount = Column(Float, nullable=False)
-    raw_data = Column(JSON)
-    fetched_at = Column(DateTime, default=datetime.utcnow)
+    raw_data = Column(JSON(none_as_null=True))  # устарело: исходный ответ хранится в raw_payloads
+    raw_payload_hash = Column(String(64))  # ссылка на raw_payloads.hash
+    fetched_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    
+    snapshot_id = Column(String(32))  # идентификатор снимка (одного запроса к API)
+    
+    __table_args__ = (
+        Index('ix_predictions_fetched_at', 'fetched_at'),
+        Index('ix_predictions_snapshot_id', 'snapshot_id'),
+        {'postgresql_partition_by': 'RANGE (fetched_at)'},
+    )
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -40,12 +60,26 @@ class Transaction(Base):
     balance = Column(String(50), nullable=False)
     price = Column(Float, nullable=False)
     state = Column(String(50), nullable=False)
-    created = Column(DateTime, nullable=False)
+    # created входит в первичный ключ только потому, что по нему секционирована таблица: PostgreSQL требует
+    # ключ секционирования в каждом уникальном ограничении. Уникальность id ключ больше не гарантирует, поэтому
+    # при загрузке строка с тем же id и прежним created удаляется (loaders._delete_moved_transactions)
+    created = Column(DateTime, primary_key=True)
     service_name = Column(String(255))  # из server_meta.en.full_name
     operation = Column(String(255))  # из server_meta.en.operation
     service = Column(String(255))  # из server_meta.en.service
-    raw_data = Column(JSON)
+    raw_data = Column(JSON(none_as_null=True))  # устарело: исходный ответ хранится в raw_payloads
+    raw_payload_hash = Column(String(64))  # ссылка на raw_payloads.hash
     fetched_at = Column(DateTime, default=datetime.utcnow)
+    content_hash = Column(String(64))  # SHA-256 канонического JSON транзакции: неизменная строка не перезаписывается
+    
+    __table_args__ = (
+        Index('ix_transactions_created', 'created'),
+        Index('ix_transactions_service', 'service'),
+        # Покрывающий индекс для расходов по услугам: только списания, без обращения к таблице
+        Index('ix_transactions_spend', 'created', 'service', postgresql_include=['price'],
+              postgresql_where=text('price < 0')),
+        {'postgresql_partition_by': 'RANGE (created)'},
+    )
 
 class ProjectReport(Base):
     __tablename__ = 'project_reports'
@@ -56,12 +90,121 @@ class ProjectReport(Base):
     project_name = Column(String(255), nullable=False)
     balance_type = Column(String(50), nullable=False)  # main, bonus
     value = Column(Float, nullable=False)
-    raw_data = Column(JSON)
+    raw_data = Column(JSON(none_as_null=True))  # устарело: исходный ответ хранится в raw_payloads
+    raw_payload_hash = Column(String(64))  # ссылка на raw_payloads.hash
     fetched_at = Column(DateTime, default=datetime.utcnow)
+    content_hash = Column(String(64))  # SHA-256 значений строки: неизменная строка не перезаписывается
     
     # Составной уникальный индекс для предотвращения дублирования
     __table_args__ = (
-        {'mysql_engine': 'InnoDB'},
+        UniqueConstraint('year', 'month', 'project_name', 'balance_type', name='uq_project_reports_period'),
+    )
+
+class MonthlyServiceSpend(Base):
+    __tablename__ = 'monthly_service_spend'
+    
+    month = Column(Date, primary_key=True)  # первое число месяца
+    service = Column(String(255), primary_key=True)  # '' для транзакций без услуги
+    balance = Column(String(50), primary_key=True)
+    total_spent = Column(Float, nullable=False)  # SUM(ABS(price)) по списаниям
+    transactions_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class DailyServiceSpend(Base):
+    __tablename__ = 'daily_service_spend'
+    
+    day = Column(Date, primary_key=True)
+    service = Column(String(255), primary_key=True)  # '' для транзакций без услуги
+    balance = Column(String(50), primary_key=True)
+    total_spent = Column(Float, nullable=False)  # SUM(ABS(price)) по списаниям
+    transactions_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class RawPayload(Base):
+    __tablename__ = 'raw_payloads'
+    
+    hash = Column(String(64), primary_key=True)  # SHA-256 канонического JSON
+    codec = Column(String(10), nullable=False)  # алгоритм сжатия data
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer)  # размер несжатого JSON, байт
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class LatestSnapshot(Base):
+    __tablename__ = 'latest_snapshots'
+    
+    stream = Column(String(50), primary_key=True)  # balances, predictions
+    snapshot_id = Column(String(32), nullable=False)
+    fetched_at = Column(DateTime, nullable=False)
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    
+    stream = Column(String(50), primary_key=True)  # transactions, project_reports, balances, predictions
+    cursor = Column(DateTime, nullable=False)  # created_to последней успешной синхронизации
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class SyncWindow(Base):
+    __tablename__ = 'sync_windows'
+    
+    stream = Column(String(50), primary_key=True)  # transactions, project_reports
+    window_start = Column(DateTime, primary_key=True)  # начало календарного месяца
+    window_end = Column(DateTime, nullable=False)
+    rows = Column(Integer)  # количество записей, полученных за окно
+    completed_at = Column(DateTime, nullable=False)  # окно закрыто и загружено (заморожено): повторно запрашивается только с --force
+
+class TransactionWindowSize(Base):
+    __tablename__ = 'transaction_window_sizes'
+    
+    month = Column(DateTime, primary_key=True)  # начало календарного месяца
+    granularity = Column(String(10), nullable=False)  # month, week, day, hour - с какого дробления начинать запросы
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    
+    version = Column(Integer, primary_key=True)  # номер примененной миграции (migrations.MIGRATIONS)
+    description = Column(String(255))
+    applied_at = Column(DateTime, nullable=False)
+
+class EtlRun(Base):
+    __tablename__ = 'etl_runs'
+    
+    id = Column(Integer, primary_key=True)
+    mode = Column(String(10), nullable=False)  # sync, async
+    full_sync = Column(Boolean, nullable=False)
+    status = Column(String(20), nullable=False)  # running, success, partial, failed
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+    duration_seconds = Column(Float)
+    
+    __table_args__ = (
+        Index('ix_etl_runs_started_at', 'started_at'),
+    )
+
+class EtlRunStage(Base):
+    __tablename__ = 'etl_run_stages'
+    
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('etl_runs.id', ondelete='CASCADE'), nullable=False)
+    stage = Column(String(50), nullable=False)  # balances, predictions, transactions, project_reports
+    status = Column(String(20), nullable=False)  # success, partial, failed
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=False)
+    duration_seconds = Column(Float, nullable=False)
+    http_requests = Column(Integer, nullable=False, default=0)
+    http_bytes = Column(Integer, nullable=False, default=0)
+    http_retries = Column(Integer, nullable=False, default=0)
+    http_failures = Column(Integer, nullable=False, default=0)
+    http_seconds = Column(Float, nullable=False, default=0.0)
+    # Гистограмма задержек API: {"0.1": n, ..., "+Inf": n}, границы корзин в секундах
+    http_latency_histogram = Column(JSON)
+    rows_inserted = Column(Integer, nullable=False, default=0)
+    rows_updated = Column(Integer, nullable=False, default=0)
+    rows_unchanged = Column(Integer, nullable=False, default=0)  # получены из API, но не изменились
+    errors = Column(Text)  # ошибки этапа, по одной на строку
+    
+    __table_args__ = (
+        Index('ix_etl_run_stages_run_id', 'run_id'),
     )
 
 
@@ -75,94 +218,60 @@ def get_database_url():
     
     return f"postgresql://{user}:{password}@{host}:{port}/{name}"
 
+_engine = None
+_session_factory = None
+
+def _pool_options():
+    """Настройки пула соединений из переменных окружения"""
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 5)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True
+    }
+
+def get_engine():
+    """Получить общий движок с пулом соединений (создается при первом обращении)"""
+    global _engine
+    if _engine is None:
+        connect_args = {}
+        statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+        if statement_timeout > 0:
+            connect_args['options'] = f"-c statement_timeout={statement_timeout}"
+        
+        _engine = create_engine(get_database_url(), connect_args=connect_args, **_pool_options())
+    return _engine
+
+def create_async_db_engine():
+    """Создать асинхронный движок (asyncpg) с теми же настройками пула"""
+    # Импорт только для --async: синхронный запуск из cron не загружает sqlalchemy.ext.asyncio
+    from sqlalchemy.ext.asyncio import create_async_engine
+    
+    connect_args = {}
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout > 0:
+        connect_args['server_settings'] = {'statement_timeout': str(statement_timeout)}
+    
+    url = get_database_url().replace('postgresql://', 'postgresql+asyncpg://', 1)
+    return create_async_engine(url, connect_args=connect_args, **_pool_options())
+
+def dispose_engine():
+    """Закрыть все соединения пула и сбросить общий движок"""
+    global _engine, _session_factory
+    if _engine is not None:
+        _engine.dispose()
+    _engine = None
+    _session_factory = None
+
 def create_session():
     """Создать сессию базы данных"""
-    engine = create_engine(get_database_url())
-    Session = sessionmaker(bind=engine)
-    return Session()
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(bind=get_engine())
+    return _session_factory()
 
 def init_database():
-    """Инициализировать базу данных и создать таблицы"""
-    engine = create_engine(get_database_url())
-    Base.metadata.create_all(engine) 
-    # Легкая миграция: убедиться, что новые колонки существуют
-    with engine.connect() as conn:
-        # Добавляем колонку balance_type в balances, если её нет
-        conn.execute(text("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns
-                    WHERE table_name='balances' AND column_name='balance_type'
-                ) THEN
-                    ALTER TABLE balances ADD COLUMN balance_type VARCHAR(50);
-                END IF;
-            END$$;
-        """))
-        
-        # Миграция для таблицы predictions: удаляем старые колонки и добавляем новые
-        conn.execute(text("""
-            DO $$
-            BEGIN
-                -- Проверяем, нужна ли миграция (если есть старая колонка period_start)
-                IF EXISTS (
-                    SELECT 1 FROM information_schema.columns
-                    WHERE table_name='predictions' AND column_name='period_start'
-                ) THEN
-                    -- Удаляем данные из старой таблицы
-                    DELETE FROM predictions;
-                    
-                    -- Удаляем старые колонки
-                    ALTER TABLE predictions DROP COLUMN IF EXISTS period_start;
-                    ALTER TABLE predictions DROP COLUMN IF EXISTS period_end;
-                    ALTER TABLE predictions DROP COLUMN IF EXISTS confidence_level;
-                    ALTER TABLE predictions DROP COLUMN IF EXISTS currency;
-                    
-                    -- Добавляем новую колонку balance_type, если её нет
-                    IF NOT EXISTS (
-                        SELECT 1 FROM information_schema.columns
-                        WHERE table_name='predictions' AND column_name='balance_type'
-                    ) THEN
-                        ALTER TABLE predictions ADD COLUMN balance_type VARCHAR(50) NOT NULL DEFAULT 'primary';
-                    END IF;
-                END IF;
-            END$$;
-        """))
-        
-        # Удаление таблицы summary_stats (статистика по проектам больше не нужна)
-        conn.execute(text("""
-            DROP TABLE IF EXISTS summary_stats;
-        """))
-        
-        # Добавление новых колонок в таблицу transactions
-        conn.execute(text("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns
-                    WHERE table_name='transactions' AND column_name='operation'
-                ) THEN
-                    ALTER TABLE transactions ADD COLUMN operation VARCHAR(255);
-                END IF;
-                
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns
-                    WHERE table_name='transactions' AND column_name='service'
-                ) THEN
-                    ALTER TABLE transactions ADD COLUMN service VARCHAR(255);
-                END IF;
-            END$$;
-        """))
-        
-        # Переименование колонки account_id в balance_id в таблице balances
-        conn.execute(text("""
-            DO $$
-            BEGIN
-                IF EXISTS (
-                    SELECT 1 FROM information_schema.columns
-                    WHERE table_name='balances' AND column_name='account_id'
-                ) THEN
-                    ALTER TABLE balances RENAME COLUMN account_id TO balance_id;
-                END IF;
-            END$$;
-        """))
\ No newline at end of file
+    """Привести схему базы данных к текущей версии (см. migrations.py)"""
+    # Импорт здесь: миграции сами импортируют модели
+    from migrations import migrate
+    migrate(get_engine())
@@ -0,0 +1,138 @@
+"""
+Разбор ответов Selectel API в строки таблиц (общий для синхронного и асинхронного ETL)
+"""
+
+from datetime import datetime
+from typing import NamedTuple, Optional
+from loguru import logger
+
+
+def parse_balances(data):
+    """Преобразовать ответ /v3/balances в строки таблицы balances"""
+    # Получаем данные из правильной структуры ответа
+    response_data = data.get('data', {})
+    billings = response_data.get('billings', [])
+
+    rows = []
+    for billing in billings:
+        for balance_data in billing.get('balances', []):
+            rows.append({
+                'balance_id': str(balance_data.get('balance_id')),
+                'balance_type': balance_data.get('balance_type'),
+                'currency': 'RUB',
+                'amount': float(balance_data.get('value', 0)),
+                'credit_limit': None,
+                'status': 'active',
+                'raw_data': balance_data
+            })
+    return rows
+
+
+def parse_predictions(data):
+    """Преобразовать ответ /v2/billing/prediction в строки таблицы predictions"""
+    response_data = data.get('data', {})
+
+    rows = []
+    # Обрабатываем каждый тип баланса из ответа API
+    for balance_type, predicted_amount in response_data.items():
+        # Пропускаем null значения
+        if predicted_amount is None:
+            logger.debug(f"Пропускаем {balance_type}: значение null")
+            continue
+
+        rows.append({
+            'balance_type': balance_type,
+            'predicted_amount': float(predicted_amount),
+            'raw_data': response_data
+        })
+    return rows
+
+
+class TransactionRecord(NamedTuple):
+    """Разобранная транзакция: компактный кортеж вместо словаря на каждую строку"""
+    # Порядок полей совпадает с колонками таблицы transactions (см. loaders.transaction_params)
+    id: int
+    transaction_type: Optional[str]
+    transaction_group: Optional[str]
+    balance: Optional[str]
+    price: float
+    state: Optional[str]
+    created: Optional[datetime]
+    service_name: Optional[str]
+    operation: Optional[str]
+    service: Optional[str]
+    raw_data: Optional[dict]
+
+
+def _parse_created(created_str):
+    """Разобрать дату создания транзакции (ISO 8601, в том числе с суффиксом Z)"""
+    if not created_str:
+        return None
+    try:
+        if created_str[-1] == 'Z':
+            created_str = created_str[:-1] + '+00:00'
+        return datetime.fromisoformat(created_str)
+    except ValueError:
+        logger.warning(f"Не удалось распарсить дату: {created_str}")
+        return datetime.utcnow()
+
+
+def parse_transactions(transactions_data):
+    """Преобразовать страницу транзакций в список TransactionRecord, пропуская записи без ID"""
+    records = []
+    append = records.append
+    empty = {}
+    for item in transactions_data:
+        # Берем минимальное значение из массива ID
+        id_list = (item.get('id_meta') or empty).get('id')
+        if not id_list or not isinstance(id_list, list):
+            logger.warning("Пропускаем транзакцию без ID")
+            continue
+
+        # Поля услуги берем из server_meta.en
+        server_meta = item.get('server_meta')
+        en_meta = server_meta.get('en') if isinstance(server_meta, dict) else None
+        if not isinstance(en_meta, dict):
+            en_meta = empty
+
+        append(TransactionRecord(
+            min(id_list),
+            item.get('transaction_type'),
+            item.get('transaction_group'),
+            item.get('balance'),
+            float(item.get('price', 0)),
+            item.get('state'),
+            _parse_created(item.get('created')),
+            en_meta.get('full_name'),
+            en_meta.get('operation'),
+            en_meta.get('service'),
+            item
+        ))
+    return records
+
+
+def parse_project_report(data, year, month):
+    """Преобразовать отчет /v1/billing/report/by_project/detailed в строки таблицы project_reports"""
+    report_data = data.get('data', {})
+    projects = report_data.get('projects', [])
+
+    rows = []
+    for project in projects:
+        project_name = project.get('name')
+        if not project_name:
+            continue
+
+        for balance_info in project.get('paid_by_balance', []):
+            balance_type = balance_info.get('balance')
+            if not balance_type:
+                continue
+
+            rows.append({
+                'year': year,
+                'month': month,
+                'project_name': project_name,
+                'balance_type': balance_type,
+                'value': float(balance_info.get('value', 0)),
+                'raw_data': project
+            })
+    return rows
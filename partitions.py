@@ -0,0 +1,295 @@
+"""
+Помесячное секционирование transactions, balances и predictions: создание секций и хранение снимков
+"""
+
+import os
+import re
+from datetime import datetime
+from loguru import logger
+from sqlalchemy import text
+from models import Base, get_engine
+
+# Секционируемые таблицы и ключ секционирования (RANGE по календарным месяцам)
+PARTITIONED_TABLES = {
+    'transactions': 'created',
+    'balances': 'fetched_at',
+    'predictions': 'fetched_at'
+}
+
+# Таблицы снимков, к которым применяется политика хранения
+SNAPSHOT_TABLES = ('balances', 'predictions')
+
+# На сколько месяцев вперед секции создаются заранее
+PARTITIONS_AHEAD_MONTHS = int(os.getenv('PARTITIONS_AHEAD_MONTHS', 2))
+# Сколько месяцев снимки хранятся целиком; в более старых остается последний снимок за день (0 - не прореживать)
+SNAPSHOT_FULL_RETENTION_MONTHS = int(os.getenv('SNAPSHOT_FULL_RETENTION_MONTHS', 3))
+# Сколько месяцев снимки хранятся вообще; более старые секции удаляются (0 - бессрочно)
+SNAPSHOT_RETENTION_MONTHS = int(os.getenv('SNAPSHOT_RETENTION_MONTHS', 0))
+
+# Комментарий к секции, которая уже прорежена до дневных снимков
+DOWNSAMPLED_COMMENT = 'downsampled: daily'
+# Строки без snapshot_id (записанные до появления снимков) получали fetched_at построчно: снимком такой строки
+# считаются строки без snapshot_id, записанные не раньше чем за этот интервал до нее
+LEGACY_SNAPSHOT_WINDOW = '1 minute'
+
+
+def _month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    """Имя помесячной секции: transactions_2024_01"""
+    return f"{table}_{month:%Y_%m}"
+
+
+def is_partitioned(conn, table):
+    """Таблица уже создана как секционированная"""
+    return conn.execute(text("""
+        SELECT 1
+        FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = :table
+    """), {'table': table}).scalar() is not None
+
+
+def _partitions(conn, table):
+    """Имена всех секций таблицы"""
+    return set(conn.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+    """), {'table': table}).scalars())
+
+
+def _monthly_partitions(table, names):
+    """Помесячные секции таблицы из списка имен [(имя, начало месяца)] по возрастанию месяца"""
+    pattern = re.compile(rf'^{table}_(\d{{4}})_(\d{{2}})$')
+    months = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            months.append((name, datetime(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(months, key=lambda partition: partition[1])
+
+
+def _partition_catalog(conn, tables):
+    """Секции секционированных таблиц с комментариями {таблица: {секция: комментарий}} одним запросом"""
+    catalog = {}
+    rows = conn.execute(text("""
+        SELECT p.relname, c.relname, obj_description(c.oid, 'pg_class')
+        FROM pg_partitioned_table pt
+        JOIN pg_class p ON p.oid = pt.partrelid
+        LEFT JOIN pg_inherits i ON i.inhparent = p.oid
+        LEFT JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE p.relname = ANY(:tables)
+    """), {'tables': list(tables)})
+    for table, name, comment in rows:
+        partitions = catalog.setdefault(table, {})
+        if name is not None:
+            partitions[name] = comment
+    return catalog
+
+
+def ensure_partitions(conn, table, start_date, end_date):
+    """Создать недостающие помесячные секции таблицы на период [start_date, end_date), вернуть имена созданных"""
+    column = PARTITIONED_TABLES[table]
+    # Секции одной таблицы не создаются одновременно из параллельных потоков и процессов
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {'key': f'partitions:{table}'})
+    existing = _partitions(conn, table)
+
+    # Строки вне созданных секций (например, загрузка истории) попадают в секцию по умолчанию
+    default = f"{table}_default"
+    if default not in existing:
+        conn.execute(text(f"CREATE TABLE {default} PARTITION OF {table} DEFAULT"))
+
+    created = []
+    month = _month_start(start_date)
+    while month < end_date:
+        next_month = _add_months(month, 1)
+        name = partition_name(table, month)
+        if name not in existing:
+            # Строки месяца, уже лежащие в секции по умолчанию, переносятся в новую секцию до ее подключения
+            conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+            conn.execute(text(f"""
+                WITH moved AS (
+                    DELETE FROM {default}
+                    WHERE {column} >= :month_from AND {column} < :month_to
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """), {'month_from': month, 'month_to': next_month})
+            conn.execute(text(
+                f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')"
+            ))
+            created.append(name)
+        month = next_month
+    return created
+
+
+def ensure_table_partitions(table, start_date, end_date, engine=None):
+    """Создать секции таблицы на период, если таблица секционирована"""
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        if not is_partitioned(conn, table):
+            return []
+        created = ensure_partitions(conn, table, start_date, end_date)
+    if created:
+        logger.info(f"Таблица {table}: созданы секции {', '.join(created)}")
+    return created
+
+
+def create_upcoming_partitions(conn):
+    """Создать секции всех секционированных таблиц на текущий и PARTITIONS_AHEAD_MONTHS следующих месяцев
+
+    Работает в транзакции переданного соединения (например, шага миграции), а не в собственных.
+    """
+    start, end = _upcoming_range(datetime.utcnow())
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table):
+            continue
+        created = ensure_partitions(conn, table, start, end)
+        if created:
+            logger.info(f"Таблица {table}: созданы секции {', '.join(created)}")
+
+
+def _downsample_partition(conn, name):
+    """Оставить в секции снимков только последний снимок каждого дня, вернуть количество удаленных строк"""
+    return conn.execute(text(f"""
+        DELETE FROM {name} t
+        USING (
+            SELECT DISTINCT ON (fetched_at::date) fetched_at::date AS day, fetched_at, snapshot_id
+            FROM {name}
+            ORDER BY fetched_at::date, fetched_at DESC
+        ) keep
+        WHERE t.fetched_at::date = keep.day
+          AND (
+            t.snapshot_id IS DISTINCT FROM keep.snapshot_id
+            OR (keep.snapshot_id IS NULL AND t.fetched_at <= keep.fetched_at - INTERVAL '{LEGACY_SNAPSHOT_WINDOW}')
+          )
+    """)).rowcount
+
+
+def _mark_downsampled(conn, name):
+    """Пометить секцию прореженной, чтобы следующие запуски ее не обходили"""
+    conn.execute(text(f"COMMENT ON TABLE {name} IS '{DOWNSAMPLED_COMMENT}'"))
+
+
+def _upcoming_range(now):
+    """Период [начало, конец), на который секции создаются заранее"""
+    current = _month_start(now)
+    return current, _add_months(current, PARTITIONS_AHEAD_MONTHS + 1)
+
+
+def _missing_upcoming(table, partitions, now):
+    """Нет секции по умолчанию или секции одного из ближайших месяцев"""
+    start, end = _upcoming_range(now)
+    month = start
+    while month < end:
+        if partition_name(table, month) not in partitions:
+            return True
+        month = _add_months(month, 1)
+    return f"{table}_default" not in partitions
+
+
+def _retention_plan(table, partitions, now):
+    """Секции снимков, которые нужно удалить или проредить: [(имя, 'drop' | 'downsample')]"""
+    current = _month_start(now)
+    drop_before = _add_months(current, -SNAPSHOT_RETENTION_MONTHS) if SNAPSHOT_RETENTION_MONTHS > 0 else None
+    downsample_before = _add_months(current, -SNAPSHOT_FULL_RETENTION_MONTHS) if SNAPSHOT_FULL_RETENTION_MONTHS > 0 else None
+
+    plan = []
+    for name, month in _monthly_partitions(table, partitions):
+        month_end = _add_months(month, 1)
+        if drop_before and month_end <= drop_before:
+            plan.append((name, 'drop'))
+        elif downsample_before and month_end <= downsample_before and partitions[name] != DOWNSAMPLED_COMMENT:
+            plan.append((name, 'downsample'))
+    return plan
+
+
+def apply_snapshot_retention(conn, table, now):
+    """Удалить секции снимков старше SNAPSHOT_RETENTION_MONTHS и проредить старше SNAPSHOT_FULL_RETENTION_MONTHS"""
+    partitions = _partition_catalog(conn, [table]).get(table, {})
+    for name, action in _retention_plan(table, partitions, now):
+        if action == 'drop':
+            # Удаление секции целиком не оставляет мертвых строк, в отличие от DELETE
+            conn.execute(text(f"DROP TABLE {name}"))
+            logger.info(f"Таблица {table}: удалена секция {name} (хранение {SNAPSHOT_RETENTION_MONTHS} мес.)")
+        else:
+            deleted = _downsample_partition(conn, name)
+            _mark_downsampled(conn, name)
+            logger.info(f"Таблица {table}: секция {name} прорежена до дневных снимков, удалено {deleted} строк")
+
+
+def maintain_partitions(engine=None):
+    """Создать секции на ближайшие месяцы и применить политику хранения снимков
+
+    Обычный запуск, когда все секции на месте и прореживать нечего, обходится одним запросом к каталогу.
+    """
+    engine = engine or get_engine()
+    now = datetime.utcnow()
+    with engine.connect() as conn:
+        catalog = _partition_catalog(conn, PARTITIONED_TABLES)
+
+    start, end = _upcoming_range(now)
+    for table, partitions in catalog.items():
+        if _missing_upcoming(table, partitions, now):
+            ensure_table_partitions(table, start, end, engine)
+
+    for table in SNAPSHOT_TABLES:
+        if table in catalog and _retention_plan(table, catalog[table], now):
+            with engine.begin() as conn:
+                apply_snapshot_retention(conn, table, now)
+
+
+def partition_existing_tables(engine=None):
+    """Одноразовая миграция: перевести несекционированные таблицы на помесячные секции
+
+    Таблица блокируется на время копирования, поэтому ETL на время миграции нужно остановить.
+    """
+    engine = engine or get_engine()
+    for table, column in PARTITIONED_TABLES.items():
+        with engine.begin() as conn:
+            if is_partitioned(conn, table):
+                logger.info(f"Таблица {table} уже секционирована")
+                continue
+
+            conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+            heap = f"{table}_heap"
+            # Индексы и ограничения старой таблицы переименовываются, чтобы освободить имена для новой
+            for index_name in conn.execute(
+                text("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = :table"),
+                {'table': table}
+            ).scalars():
+                conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_heap"'))
+            conn.execute(text(f"ALTER TABLE {table} RENAME TO {heap}"))
+            Base.metadata.tables[table].create(conn)
+
+            now = datetime.utcnow()
+            first, last = conn.execute(text(f"SELECT MIN({column}), MAX({column}) FROM {heap}")).one()
+            end_date = _add_months(_month_start(max(last or now, now)), PARTITIONS_AHEAD_MONTHS + 1)
+            ensure_partitions(conn, table, first or now, end_date)
+
+            # Ключ секционирования входит в первичный ключ, поэтому пустые значения уходят в секцию по умолчанию
+            columns = [table_column.name for table_column in Base.metadata.tables[table].columns]
+            select_list = ', '.join(
+                f"COALESCE({name}, 'epoch'::timestamp)" if name == column else name for name in columns
+            )
+            moved = conn.execute(text(
+                f"INSERT INTO {table} ({', '.join(columns)}) SELECT {select_list} FROM {heap}"
+            )).rowcount
+            # Последовательность id новой таблицы продолжает нумерацию старой
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+            ))
+            conn.execute(text(f"DROP TABLE {heap}"))
+        logger.info(f"Таблица {table}: перенесено в секции {moved} строк")
+
+    logger.info("Секционирование завершено")
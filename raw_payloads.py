@@ -0,0 +1,142 @@
+"""
+Архив исходных ответов API: сжатые JSON-документы с адресацией по хешу содержимого
+"""
+
+import hashlib
+import json
+import os
+import zlib
+from loguru import logger
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects.postgresql import insert
+from models import Balance, Prediction, ProjectReport, RawPayload, Transaction, create_session
+
+# Потоки, для которых сохраняется исходный ответ API (пустое значение - ни для каких)
+RAW_RETENTION_STREAMS = {
+    stream.strip()
+    for stream in os.getenv('RAW_RETENTION_STREAMS', 'balances,predictions,transactions,project_reports').split(',')
+    if stream.strip()
+}
+
+# Таблицы с колонкой raw_data, которые переносятся в архив при компактификации
+STREAM_MODELS = {
+    'balances': Balance,
+    'predictions': Prediction,
+    'transactions': Transaction,
+    'project_reports': ProjectReport
+}
+
+CODEC = 'zlib'
+
+
+def _canonical_json(payload):
+    """Каноническое представление JSON: одинаковые документы дают одинаковые байты"""
+    return json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def payload_hash(payload):
+    """SHA-256 канонического JSON документа"""
+    return hashlib.sha256(_canonical_json(payload)).hexdigest()
+
+
+def load_raw_payload(session, payload_hash_value):
+    """Прочитать и распаковать исходный ответ по хешу"""
+    payload = session.get(RawPayload, payload_hash_value)
+    if payload is None:
+        return None
+    return json.loads(zlib.decompress(payload.data))
+
+
+def _store_payloads(session, payloads):
+    """Записать документы {hash: payload} в архив, пропуская уже сохраненные"""
+    if not payloads:
+        return
+    records = []
+    # Одинаковый порядок вставки в параллельных потоках исключает взаимоблокировки
+    for hash_value in sorted(payloads):
+        document = _canonical_json(payloads[hash_value])
+        records.append({
+            'hash': hash_value,
+            'codec': CODEC,
+            'data': zlib.compress(document),
+            'size': len(document)
+        })
+    session.execute(insert(RawPayload.__table__).on_conflict_do_nothing(index_elements=['hash']), records)
+
+
+def archive_payloads(session, stream, payloads, known_hashes=None):
+    """Сохранить документы в архив согласно настройкам потока и вернуть их хеши (None - не сохранен)
+
+    known_hashes - уже посчитанные payload_hash тех же документов, чтобы не хешировать их повторно
+    """
+    if stream not in RAW_RETENTION_STREAMS:
+        return [None] * len(payloads)
+
+    documents = {}
+    hashes_by_id = {}
+    hashes = []
+    for index, payload in enumerate(payloads):
+        if payload is None:
+            hashes.append(None)
+            continue
+        # Один и тот же объект (например, весь ответ прогнозов) хешируем один раз
+        hash_value = hashes_by_id.get(id(payload))
+        if hash_value is None:
+            hash_value = known_hashes[index] if known_hashes is not None else payload_hash(payload)
+            hashes_by_id[id(payload)] = hash_value
+            documents[hash_value] = payload
+        hashes.append(hash_value)
+
+    _store_payloads(session, documents)
+    return hashes
+
+
+def archive_raw_data(session, stream, rows):
+    """Заменить raw_data в строках ссылкой на архив (raw_payload_hash) согласно настройкам потока"""
+    hashes = archive_payloads(session, stream, [row.get('raw_data') for row in rows])
+    for row, hash_value in zip(rows, hashes):
+        row['raw_data'] = None
+        row['raw_payload_hash'] = hash_value
+    return rows
+
+
+def compact_raw_data(batch_size=1000):
+    """Одноразовая миграция: перенести raw_data всех таблиц в архив и очистить колонку"""
+    for stream, model in STREAM_MODELS.items():
+        table = model.__table__
+        if stream not in RAW_RETENTION_STREAMS:
+            # Архив для потока выключен: очистка raw_data уничтожила бы единственную копию ответа
+            logger.warning(f"Таблица {table.name}: поток {stream} не входит в RAW_RETENTION_STREAMS, raw_data не переносится")
+            continue
+        moved = 0
+        while True:
+            session = create_session()
+            try:
+                batch = session.execute(
+                    select(table.c.id, table.c.raw_data)
+                    .where(table.c.raw_data.isnot(None))
+                    .order_by(table.c.id)
+                    .limit(batch_size)
+                ).all()
+                if not batch:
+                    break
+
+                rows = [{'id': row_id, 'raw_data': raw_data} for row_id, raw_data in batch]
+                archive_raw_data(session, stream, rows)
+                session.execute(
+                    update(table)
+                    .where(table.c.id == bindparam('row_id'))
+                    .values(raw_data=None, raw_payload_hash=bindparam('payload_hash')),
+                    [{'row_id': row['id'], 'payload_hash': row['raw_payload_hash']} for row in rows]
+                )
+                session.commit()
+                moved += len(rows)
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+        logger.info(f"Таблица {table.name}: перенесено в архив {moved} записей raw_data")
+
+    logger.info("Компактификация raw_data завершена. Чтобы вернуть место на диске, выполните VACUUM FULL для перечисленных таблиц")
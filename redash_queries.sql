@@ -13,50 +13,75 @@ SELECT
     value/100 as sum,
     fetched_at
 FROM project_reports 
-WHERE year = EXTRACT(YEAR FROM CURRENT_DATE)
+WHERE year = EXTRACT(YEAR FROM CURRENT_DATE)::int
 ORDER BY year DESC, month DESC, value DESC;
 
 -- 2. Прогнозы расходов
 -- Запрос: Прогнозы в днях до исчерпания баланса
+-- (последний снимок берется по указателю latest_snapshots, а не через MAX(fetched_at);
+--  условие по fetched_at оставляет для чтения одну помесячную секцию predictions)
 SELECT
-    balance_type,
-    predicted_amount/24 as days,
-    fetched_at
-FROM predictions 
-WHERE fetched_at = (SELECT MAX(fetched_at) FROM predictions)
-ORDER BY predicted_amount DESC;
+    p.balance_type,
+    p.predicted_amount/24 as days,
+    p.fetched_at
+FROM latest_snapshots l
+JOIN predictions p ON p.snapshot_id = l.snapshot_id AND p.fetched_at = l.fetched_at
+WHERE l.stream = 'predictions'
+ORDER BY p.predicted_amount DESC;
 
 -- 3. Транзакции
 -- Запрос: Расходы по услугам по месяцам
+-- (читает агрегат monthly_service_spend, который ETL пересчитывает за затронутые месяцы;
+--  по дням - daily_service_spend с колонкой day)
 SELECT
-    DATE_TRUNC('month', created)::date AS month,
-    service,
-    SUM(ABS(price))/100 AS total_spent
-FROM transactions
-WHERE price < 0
+    month,
+    NULLIF(service, '') AS service,
+    SUM(total_spent)/100 AS total_spent
+FROM monthly_service_spend
 GROUP BY month, service
 ORDER BY month, service;
 
 -- 4. Баланс
 -- Запрос: Текущий общий баланс (последние данные)
-WITH t AS (
-  SELECT
-    amount,
-    date_trunc('minute', fetched_at) AS fetched_min
-  FROM balances
-),
-max_minute AS (
-  SELECT MAX(fetched_min) AS fetched_min
-  FROM (
-    SELECT fetched_min
-    FROM t
-    GROUP BY fetched_min
-    HAVING COUNT(*) > 1
-  ) dups
-)
-SELECT 
-    t.fetched_min,
-    SUM(t.amount)/100 AS total_amount
-FROM t
-JOIN max_minute m ON t.fetched_min = m.fetched_min
-GROUP BY t.fetched_min;
\ No newline at end of file
+SELECT
+    date_trunc('minute', l.fetched_at) AS fetched_min,
+    SUM(b.amount)/100 AS total_amount
+FROM latest_snapshots l
+JOIN balances b ON b.snapshot_id = l.snapshot_id AND b.fetched_at = l.fetched_at
+WHERE l.stream = 'balances'
+GROUP BY l.fetched_at;
+
+-- 5. Запуски ETL
+-- Запрос: Статус и длительность запусков за последние 14 дней (журнал etl_runs)
+SELECT
+    id,
+    started_at,
+    mode,
+    full_sync,
+    status,
+    duration_seconds
+FROM etl_runs
+WHERE started_at >= CURRENT_DATE - INTERVAL '14 days'
+ORDER BY started_at DESC;
+
+-- 6. Этапы ETL
+-- Запрос: Тайминги этапов, запросы к API, гистограмма задержек (корзины в секундах) и строки по запускам
+SELECT
+    r.started_at,
+    s.stage,
+    s.status,
+    s.duration_seconds,
+    s.http_requests,
+    s.http_retries,
+    s.http_failures,
+    s.http_seconds,
+    s.http_bytes/1024 AS http_kb,
+    s.http_latency_histogram,
+    s.rows_inserted,
+    s.rows_updated,
+    s.rows_unchanged,
+    s.errors
+FROM etl_runs r
+JOIN etl_run_stages s ON s.run_id = r.id
+WHERE r.started_at >= CURRENT_DATE - INTERVAL '14 days'
+ORDER BY r.started_at DESC, s.stage;
\ No newline at end of file
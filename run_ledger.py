@@ -0,0 +1,188 @@
+"""
+Журнал запусков ETL: тайминги этапов, HTTP-статистика и количество строк в etl_runs/etl_run_stages
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from loguru import logger
+from http_client import LATENCY_BUCKETS
+from metrics import Counter, Gauge, Histogram
+from models import EtlRun, EtlRunStage, create_session
+
+# Эндпоинты API, которые запрашивает каждый этап
+STAGE_ENDPOINTS = {
+    'balances': ('/v3/balances',),
+    'predictions': ('/v2/billing/prediction',),
+    'transactions': ('/v2/billing/transactions',),
+    'project_reports': ('/v1/billing/report/by_project/detailed',)
+}
+
+STATUS_ORDER = ('success', 'partial', 'failed')
+
+ROWS_PROCESSED = Counter('selectel_etl_rows_processed_total', 'Строки, записанные ETL', ('stream', 'result'))
+RUNS = Counter('selectel_etl_runs_total', 'Запуски ETL по итоговому статусу', ('mode', 'status'))
+RUN_SECONDS = Histogram(
+    'selectel_etl_run_duration_seconds', 'Длительность запуска ETL', ('mode',), (10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+STAGE_SECONDS = Gauge('selectel_etl_stage_duration_seconds', 'Длительность этапа в последнем запуске ETL', ('stage',))
+LAST_RUN_TIMESTAMP = Gauge('selectel_etl_last_run_timestamp_seconds', 'Время завершения последнего запуска ETL (Unix)')
+LAST_SUCCESS_TIMESTAMP = Gauge(
+    'selectel_etl_last_success_timestamp_seconds', 'Время последней успешной синхронизации потока (Unix)', ('stream',)
+)
+
+
+class RunLedger:
+    def __init__(self, mode, full_sync):
+        self.mode = mode
+        self.full_sync = full_sync
+        self.run_id = None
+        self.started_at = None
+        self._started = None
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Зарегистрировать начало запуска в etl_runs"""
+        self.started_at = datetime.utcnow()
+        self._started = time.monotonic()
+        session = create_session()
+        try:
+            run = EtlRun(mode=self.mode, full_sync=self.full_sync, status='running', started_at=self.started_at)
+            session.add(run)
+            session.commit()
+            self.run_id = run.id
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Не удалось записать запуск ETL в журнал: {e}")
+        finally:
+            session.close()
+
+    @contextmanager
+    def stage(self, name):
+        """Замерить этап; исключение этапа фиксируется в журнале и не прерывает запуск"""
+        stage = self._stage(name)
+        stage['started_at'] = datetime.utcnow()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            logger.error(f"Ошибка на этапе {name}: {e}")
+            stage['failed'] = True
+            self.add_error(name, e)
+        finally:
+            stage['finished_at'] = datetime.utcnow()
+            stage['duration_seconds'] = time.monotonic() - started
+
+    def _stage(self, name):
+        with self._lock:
+            return self._stages.setdefault(name, {
+                'rows_inserted': 0,
+                'rows_updated': 0,
+                'rows_unchanged': 0,
+                'errors': [],
+                'failed': False
+            })
+
+    def add_rows(self, name, inserted=0, updated=0, unchanged=0):
+        """Учесть вставленные, обновленные и неизменные строки этапа (потокобезопасно)"""
+        stage = self._stage(name)
+        with self._lock:
+            stage['rows_inserted'] += inserted
+            stage['rows_updated'] += updated
+            stage['rows_unchanged'] += unchanged
+        ROWS_PROCESSED.inc(inserted, stream=name, result='inserted')
+        ROWS_PROCESSED.inc(updated, stream=name, result='updated')
+        ROWS_PROCESSED.inc(unchanged, stream=name, result='unchanged')
+
+    def add_error(self, name, error):
+        """Учесть ошибку этапа, которая была обработана без прерывания запуска"""
+        stage = self._stage(name)
+        with self._lock:
+            stage['errors'].append(str(error))
+
+    def _stage_record(self, name, stage, http_stats):
+        record = {
+            'stage': name,
+            'started_at': stage['started_at'],
+            'finished_at': stage['finished_at'],
+            'duration_seconds': stage['duration_seconds'],
+            'rows_inserted': stage['rows_inserted'],
+            'rows_updated': stage['rows_updated'],
+            'rows_unchanged': stage['rows_unchanged'],
+            'errors': '\n'.join(stage['errors']) or None,
+            'http_requests': 0,
+            'http_bytes': 0,
+            'http_retries': 0,
+            'http_failures': 0,
+            'http_seconds': 0.0
+        }
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        for endpoint in STAGE_ENDPOINTS.get(name, ()):
+            stats = http_stats.get(endpoint)
+            if not stats:
+                continue
+            record['http_requests'] += stats['requests']
+            record['http_bytes'] += stats['bytes']
+            record['http_retries'] += stats['retries']
+            record['http_failures'] += stats['failures']
+            record['http_seconds'] += stats['total_seconds']
+            buckets = [total + count for total, count in zip(buckets, stats['latency_buckets'])]
+        labels = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        record['http_latency_histogram'] = dict(zip(labels, buckets))
+
+        if stage['failed']:
+            record['status'] = 'failed'
+        elif stage['errors'] or record['http_failures']:
+            record['status'] = 'partial'
+        else:
+            record['status'] = 'success'
+        return record
+
+    def _export_metrics(self, records, status, duration):
+        """Обновить метрики Prometheus по итогам запуска"""
+        now = time.time()
+        for record in records:
+            STAGE_SECONDS.set(record['duration_seconds'], stage=record['stage'])
+            if record['status'] == 'success':
+                LAST_SUCCESS_TIMESTAMP.set(now, stream=record['stage'])
+        RUNS.inc(mode=self.mode, status=status)
+        RUN_SECONDS.observe(duration, mode=self.mode)
+        LAST_RUN_TIMESTAMP.set(now)
+
+    def finish(self, http_stats):
+        """Записать итоги этапов и статус запуска; возвращает записи этапов"""
+        finished_at = datetime.utcnow()
+        duration = time.monotonic() - self._started
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self._stages.items() if 'finished_at' in stage}
+        records = [self._stage_record(name, stage, http_stats) for name, stage in stages.items()]
+        status = max((record['status'] for record in records), key=STATUS_ORDER.index, default='success')
+
+        self._export_metrics(records, status, duration)
+        for record in records:
+            logger.info(
+                f"Этап {record['stage']}: {record['status']}, {record['duration_seconds']:.2f} с, "
+                f"{record['http_requests']} запросов API, {record['rows_inserted']} новых, {record['rows_updated']} обновлено, "
+                f"{record['rows_unchanged']} без изменений"
+            )
+
+        if self.run_id is None:
+            return records
+
+        session = create_session()
+        try:
+            for record in records:
+                session.add(EtlRunStage(run_id=self.run_id, **record))
+            run = session.get(EtlRun, self.run_id)
+            run.status = status
+            run.finished_at = finished_at
+            run.duration_seconds = duration
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Не удалось записать итоги запуска ETL в журнал: {e}")
+        finally:
+            session.close()
+        return records
@@ -0,0 +1,197 @@
+"""
+Планировщик потоков ETL: у каждого потока свое cron-расписание со случайной задержкой (джиттером)
+"""
+
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+from loguru import logger
+from metrics import Counter, Gauge
+
+# Расписания по умолчанию: балансы и прогнозы меняются часто и запрашиваются дешево,
+# отчеты по проектам за закрытые месяцы не меняются
+DEFAULT_SCHEDULES = {
+    'balances': '*/15 * * * *',
+    'predictions': '*/30 * * * *',
+    'transactions': '0 * * * *',
+    'project_reports': '30 */6 * * *'
+}
+
+# Максимальная случайная задержка запуска, с (разносит запросы нескольких экземпляров ETL к API)
+SCHEDULE_JITTER_SECONDS = int(os.getenv('SCHEDULE_JITTER_SECONDS', 60))
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *'
+}
+
+# Допустимые значения полей cron: минута, час, день месяца, месяц, день недели (0 и 7 - воскресенье)
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+SKIPPED_RUNS = Counter(
+    'selectel_etl_schedule_skipped_total', 'Моменты расписания потока, пропущенные из-за еще не завершенного запуска ETL',
+    ('stream',)
+)
+NEXT_RUN_TIMESTAMP = Gauge(
+    'selectel_etl_schedule_next_run_timestamp_seconds', 'Время следующего запуска потока по расписанию (Unix)', ('stream',)
+)
+
+
+def _parse_cron_field(value, name, low, high):
+    """Множество значений поля cron: *, a, a-b, списки через запятую и шаг /n"""
+    values = set()
+    for part in value.split(','):
+        part_range, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if part_range == '*':
+            start, end = low, high
+        elif '-' in part_range:
+            start, end = (int(bound) for bound in part_range.split('-', 1))
+        else:
+            start = int(part_range)
+            # a/n - от a до конца диапазона с шагом n
+            end = high if step > 1 else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"поле {name}: недопустимое значение '{part}' (диапазон {low}-{high})")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression:
+    """Cron-выражение из пяти полей (минута час день месяц день_недели) или псевдоним @hourly/@daily/..."""
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        fields = CRON_ALIASES.get(self.expression, self.expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"cron-выражение '{expression}': ожидается 5 полей, получено {len(fields)}")
+        try:
+            parsed = [_parse_cron_field(field, *spec) for field, spec in zip(fields, CRON_FIELDS)]
+        except ValueError as e:
+            raise ValueError(f"cron-выражение '{expression}': {e}") from None
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}
+        # Как в cron: если ограничены и день месяца, и день недели, достаточно совпадения одного из них.
+        # Поле, начинающееся со '*' (в том числе '*/2'), ограничением не считается, как в Vixie cron
+        self._days_restricted = not fields[2].startswith('*')
+        self._weekdays_restricted = not fields[4].startswith('*')
+
+    def _day_matches(self, value):
+        day = value.day in self.days
+        weekday = (value.weekday() + 1) % 7 in self.weekdays
+        if self._days_restricted and self._weekdays_restricted:
+            return day or weekday
+        return day and weekday
+
+    def next_after(self, value):
+        """Ближайший момент по расписанию строго после value (с точностью до минуты)"""
+        candidate = value.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Выражение вроде 30 февраля никогда не наступает: поиск ограничен несколькими годами
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                month_index = candidate.year * 12 + candidate.month
+                candidate = datetime(month_index // 12, month_index % 12 + 1, 1)
+            elif not self._day_matches(candidate):
+                candidate = datetime(candidate.year, candidate.month, candidate.day) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"cron-выражение '{self.expression}' не наступает никогда")
+
+    def __repr__(self):
+        return f"CronExpression({self.expression!r})"
+
+
+class StreamSchedule:
+    """Расписание одного потока: очередной момент по cron и фактическое время запуска с джиттером"""
+
+    def __init__(self, stream, cron, jitter_seconds=0):
+        self.stream = stream
+        self.cron = cron
+        self.jitter_seconds = jitter_seconds
+        self.tick = None
+        self.next_run = None
+
+    def plan(self, after):
+        """Запланировать ближайший запуск после after; возвращает количество пропущенных моментов расписания"""
+        skipped = 0
+        tick = self.cron.next_after(self.tick if self.tick and self.tick < after else after)
+        while tick <= after:
+            skipped += 1
+            tick = self.cron.next_after(tick)
+        self.tick = tick
+        jitter = random.uniform(0, self.jitter_seconds) if self.jitter_seconds > 0 else 0
+        self.next_run = tick + timedelta(seconds=jitter)
+        NEXT_RUN_TIMESTAMP.set(self.next_run.timestamp(), stream=self.stream)
+        return skipped
+
+
+def load_schedules(streams, jitter_seconds=None):
+    """Расписания потоков из SCHEDULE_<ПОТОК> (по умолчанию DEFAULT_SCHEDULES); пустое значение отключает поток"""
+    jitter_seconds = SCHEDULE_JITTER_SECONDS if jitter_seconds is None else jitter_seconds
+    schedules = []
+    for stream in streams:
+        expression = os.getenv(f"SCHEDULE_{stream.upper()}", DEFAULT_SCHEDULES.get(stream, '')).strip()
+        if expression:
+            schedules.append(StreamSchedule(stream, CronExpression(expression), jitter_seconds))
+    return schedules
+
+
+class StreamScheduler:
+    """Запускает потоки по их расписаниям
+
+    Потоки, подошедшие к запуску одновременно, выполняются одним запуском ETL. Запуски идут последовательно,
+    поэтому поток не перекрывается сам с собой: моменты расписания, пришедшиеся на его собственный запуск,
+    пропускаются. Между запусками планировщик спит до ближайшего момента, а не опрашивает расписание.
+    """
+
+    def __init__(self, run_streams, schedules):
+        self.run_streams = run_streams
+        self.schedules = schedules
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Остановить планировщик (текущий запуск ETL завершается)"""
+        self._stop.set()
+
+    def run_forever(self):
+        if not self.schedules:
+            logger.warning("Ни для одного потока не задано расписание, планировщик остановлен")
+            return
+
+        now = datetime.now()
+        for schedule in self.schedules:
+            schedule.plan(now)
+            logger.info(
+                f"Поток {schedule.stream}: расписание '{schedule.cron.expression}', "
+                f"первый запуск {schedule.next_run:%Y-%m-%d %H:%M:%S}"
+            )
+
+        while not self._stop.is_set():
+            next_run = min(schedule.next_run for schedule in self.schedules)
+            # Event.wait просыпается к ближайшему запуску или сразу при остановке
+            if self._stop.wait(max((next_run - datetime.now()).total_seconds(), 0)):
+                break
+
+            now = datetime.now()
+            due = [schedule for schedule in self.schedules if schedule.next_run <= now]
+            if not due:
+                continue
+            self.run_streams([schedule.stream for schedule in due])
+
+            finished = datetime.now()
+            for schedule in due:
+                skipped = schedule.plan(finished)
+                if skipped:
+                    SKIPPED_RUNS.inc(skipped, stream=schedule.stream)
+                    logger.warning(
+                        f"Поток {schedule.stream}: пропущено запусков по расписанию - {skipped} "
+                        f"(в это время шел предыдущий запуск ETL)"
+                    )
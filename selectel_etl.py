@@ -3,18 +3,116 @@
 ETL-скрипт для сбора данных Selectel Billing API
 """
 
+import sys
+import startup_profile
+
+if '--profile-startup' in sys.argv:
+    # Хук ставится до остальных импортов, иначе их время не попадет в профиль
+    startup_profile.enable()
+
+import ijson
 import requests
 import os
-import schedule
+import signal
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
 from loguru import logger
 from dotenv import load_dotenv
-from models import Balance, Prediction, Transaction, ProjectReport, create_session, init_database
+from models import create_session, dispose_engine, init_database
+from loaders import (
+    UPSERT_BATCH_SIZE, WINDOW_GRANULARITIES, advance_sync_cursor, copy_transactions, create_transactions_stage, get_completed_windows,
+    get_sync_cursor, get_window_granularities, mark_windows_completed, merge_transactions_stage, refresh_spend_rollups,
+    save_balances, save_predictions, save_window_granularities, upsert_project_reports, upsert_transactions
+)
+from parsers import parse_balances, parse_predictions, parse_project_report, parse_transactions
+from http_client import SelectelHTTPClient
+from partitions import ensure_table_partitions, maintain_partitions, partition_existing_tables
+from raw_payloads import compact_raw_data
+from run_ledger import RunLedger
 
 load_dotenv()
 
+# Максимальный размер страницы, который отдает /v2/billing/transactions
+TRANSACTIONS_PAGE_SIZE = 500
+
+# Шаг ступеней дробления окна транзакций (порядок ступеней - loaders.WINDOW_GRANULARITIES)
+WINDOW_STEPS = {'week': timedelta(days=7), 'day': timedelta(days=1), 'hour': timedelta(hours=1)}
+
+# Потоки данных в порядке выполнения внутри запуска
+STREAMS = ('balances', 'predictions', 'transactions', 'project_reports')
+
+# Сколько раз за запуск запрашивается окно транзакций, загрузка которого завершилась ошибкой
+TRANSACTION_WINDOW_ATTEMPTS = 2
+
+class TransactionWindowTask(NamedTuple):
+    """Окно транзакций для загрузки одним потоком"""
+    window: tuple  # (start, end)
+    granularity: str  # ступень дробления, с которой получено окно
+    first_page: Optional[list] = None  # уже полученная первая страница окна
+    attempt: int = 1
+
+def log_period_throughput(start_date, end_date, processed, updated, unchanged, pages, elapsed):
+    """Записать в лог итог загрузки периода транзакций и скорость обработки"""
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Обработано {processed} транзакций за период {start_date.strftime('%Y-%m-%d')} - {end_date.strftime('%Y-%m-%d')}: "
+        f"{processed - updated - unchanged} новых, {updated} обновлено, {unchanged} без изменений "
+        f"({pages} стр., {elapsed:.2f} с, {rate:.1f} строк/с)"
+    )
+
+def month_start(value):
+    """Начало календарного месяца, в который попадает value"""
+    return datetime(value.year, value.month, 1)
+
+def next_month_start(value):
+    """Начало календарного месяца, следующего за месяцем value"""
+    return datetime(value.year + 1, 1, 1) if value.month == 12 else datetime(value.year, value.month + 1, 1)
+
+def split_window(window, granularity):
+    """Разбить окно (start, end) в пределах месяца на окна гранулярности week, day или hour"""
+    start_date, end_date = window
+    if granularity == 'month':
+        return [window]
+    
+    step = WINDOW_STEPS[granularity]
+    windows = []
+    current_start = start_date
+    while current_start < end_date:
+        windows.append((current_start, min(current_start + step, end_date)))
+        current_start += step
+    return windows
+
+def finer_granularity(granularity):
+    """Следующая, более мелкая ступень дробления (None для hour)"""
+    index = WINDOW_GRANULARITIES.index(granularity) + 1
+    return WINDOW_GRANULARITIES[index] if index < len(WINDOW_GRANULARITIES) else None
+
+def finest_granularity(*granularities):
+    """Самая мелкая из ступеней дробления"""
+    return max(granularities, key=WINDOW_GRANULARITIES.index)
+
+def _item_created(item):
+    """Дата создания элемента страницы транзакций без часового пояса, как у границ окон; None, если не разобрать"""
+    try:
+        return datetime.fromisoformat(item['created'].replace('Z', '+00:00')).replace(tzinfo=None)
+    except (KeyError, AttributeError, TypeError, ValueError):
+        return None
+
+def page_fits_window(page, window):
+    """Все элементы страницы попадают в окно (start, end)"""
+    start_date, end_date = window
+    for item in page:
+        created = _item_created(item)
+        if created is None or not start_date <= created < end_date:
+            return False
+    return True
+
 class SelectelETL:
+    # Класс журнала запусков (бенчмарк подставляет журнал с дополнительными замерами)
+    ledger_class = RunLedger
+    
     def __init__(self):
         self.api_token = os.getenv('SELECTEL_API_TOKEN')
         self.base_url = os.getenv('SELECTEL_API_BASE_URL', 'https://api.selectel.ru')
@@ -26,24 +124,53 @@ class SelectelETL:
         if not self.api_token:
             raise ValueError("SELECTEL_API_TOKEN не установлен в переменных окружения")
         
-        # Инициализация базы данных
-        init_database()
+        with startup_profile.phase('HTTP-клиент'):
+            self.http = self._create_http_client()
+        # Количество месяцев, запрашиваемых параллельно при полной синхронизации
+        self.max_workers = int(os.getenv('ETL_MAX_WORKERS', 4))
+        # Перекрытие при продолжении с водяного знака (на случай запоздавших записей)
+        self.sync_overlap = timedelta(minutes=int(os.getenv('SYNC_OVERLAP_MINUTES', 15)))
+        # Через сколько дней после окончания месяц считается закрытым (поздние корректировки учтены)
+        self.close_after = timedelta(days=int(os.getenv('SYNC_CLOSE_AFTER_DAYS', 7)))
+        # Журнал текущего запуска (etl_runs), создается в run_etl
+        self.ledger = None
+        
+        # Инициализация базы данных: при актуальной схеме - один запрос к schema_version
+        with startup_profile.phase('проверка схемы БД'):
+            init_database()
         logger.info("ETL-система инициализирована")
 
+    def _create_http_client(self):
+        """HTTP-клиент для запросов к API (асинхронный ETL создает свой)"""
+        return SelectelHTTPClient(self.base_url, self.headers)
+
+    def close(self):
+        """Закрыть пул HTTP-соединений"""
+        self.http.close()
+
     def make_request(self, endpoint, params=None):
         """Выполнить HTTP-запрос к API Selectel"""
         url = f"{self.base_url}{endpoint}"
         try:
-            response = requests.get(url, headers=self.headers, params=params, timeout=30)
-            response.raise_for_status()
-            return response.json()
+            return self.http.get_json(endpoint, params)
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка при запросе к {url}: {e}")
             return None
 
+    def _record_rows(self, stage, inserted=0, updated=0, unchanged=0):
+        """Учесть сохраненные строки этапа в журнале запуска"""
+        if self.ledger is not None:
+            self.ledger.add_rows(stage, inserted, updated, unchanged)
+
+    def _record_error(self, stage, error):
+        """Учесть обработанную ошибку этапа в журнале запуска"""
+        if self.ledger is not None:
+            self.ledger.add_error(stage, error)
+
     def fetch_balances(self):
         """Получить данные о балансах"""
         logger.info("Запрос данных о балансах...")
+        fetched_at = datetime.now()
         data = self.make_request('/v3/balances')
         
         if not data:
@@ -51,37 +178,22 @@ class SelectelETL:
         
         session = create_session()
         try:
-            # Получаем данные из правильной структуры ответа
-            response_data = data.get('data', {})
-            billings = response_data.get('billings', [])
-            
-            total_balances = 0
-            for billing in billings:
-                balances = billing.get('balances', [])
-                for balance_data in balances:
-                    balance = Balance(
-                        balance_id=str(balance_data.get('balance_id')),
-                        balance_type=balance_data.get('balance_type'),
-                        currency='RUB',
-                        amount=float(balance_data.get('value', 0)),
-                        credit_limit=None,
-                        status='active',
-                        raw_data=balance_data
-                    )
-                    session.add(balance)
-                    total_balances += 1
-            
+            total_balances = save_balances(session, parse_balances(data))
+            advance_sync_cursor(session, 'balances', fetched_at)
             session.commit()
+            self._record_rows('balances', inserted=total_balances)
             logger.info(f"Сохранено {total_balances} записей о балансах")
         except Exception as e:
             session.rollback()
             logger.error(f"Ошибка при сохранении балансов: {e}")
+            self._record_error('balances', e)
         finally:
             session.close()
 
     def fetch_predictions(self):
         """Получить данные о прогнозах расходов"""
         logger.info("Запрос данных о прогнозах...")
+        fetched_at = datetime.now()
         data = self.make_request('/v2/billing/prediction')
         
         if not data:
@@ -89,202 +201,517 @@ class SelectelETL:
         
         session = create_session()
         try:
-            response_data = data.get('data', {})
-            total_predictions = 0
-            
-            # Обрабатываем каждый тип баланса из ответа API
-            for balance_type, predicted_amount in response_data.items():
-                # Пропускаем null значения
-                if predicted_amount is None:
-                    logger.debug(f"Пропускаем {balance_type}: значение null")
-                    continue
-                
-                prediction = Prediction(
-                    balance_type=balance_type,
-                    predicted_amount=float(predicted_amount),
-                    raw_data=response_data
-                )
-                session.add(prediction)
-                total_predictions += 1
-            
+            total_predictions = save_predictions(session, parse_predictions(data))
+            advance_sync_cursor(session, 'predictions', fetched_at)
             session.commit()
+            self._record_rows('predictions', inserted=total_predictions)
             logger.info(f"Сохранено {total_predictions} записей о прогнозах")
         except Exception as e:
             session.rollback()
             logger.error(f"Ошибка при сохранении прогнозов: {e}")
+            self._record_error('predictions', e)
         finally:
             session.close()
 
-    def fetch_transactions(self, full_sync=False):
-        """Получить транзакции: полная синхронизация с начала года или за последние 2 часа"""
-        session = create_session()
+    def fetch_transactions(self, full_sync=False, period=None, force=False):
+        """Получить транзакции: за период, полная синхронизация или с последнего водяного знака (force - и замороженные месяцы)"""
         try:
-            current_year = datetime.now().year
-            end_date = datetime.now()
+            watermark = None if full_sync or period else self._get_watermark('transactions')
+            start_date, end_date = self._plan_transactions_period(full_sync, watermark, period)
+            self._ensure_partitions('transactions', start_date, end_date)
             
-            if full_sync:
-                # Полная синхронизация - запрашиваем с начала года
-                start_date = datetime(current_year, 1, 1)
-                logger.info(f"Полная синхронизация: запрос транзакций с начала года ({start_date.strftime('%Y-%m-%dT%H:%M:%S')}) до сейчас ({end_date.strftime('%Y-%m-%dT%H:%M:%S')})...")
-            else:
-                # Обычный режим - запрашиваем за последние 2 часа
-                start_date = end_date - timedelta(hours=2)
-                logger.info(f"Обновление: запрос транзакций за последние 2 часа ({start_date.strftime('%Y-%m-%dT%H:%M:%S')}) до сейчас ({end_date.strftime('%Y-%m-%dT%H:%M:%S')})...")
+            # Период режется на календарные месяцы; замороженные (закрытые и уже загруженные) месяцы пропускаются
+            now = datetime.now()
+            windows = self._pending_windows(
+                'transactions', self._month_windows(start_date, end_date),
+                self._get_completed_windows('transactions', start_date, end_date), force
+            )
+            
+            # Месяцы сразу режутся на окна той гранулярности, которая понадобилась в прошлый раз
+            tasks = self._plan_transaction_tasks(windows, self._get_window_granularities(start_date, end_date))
+            if len(tasks) > 1:
+                logger.info(f"Запрос транзакций по {len(tasks)} окнам, потоков: {self.max_workers}")
+            
+            # Раздробленные окна и окна с ошибкой возвращаются в пул следующим раундом
+            loaded = []
+            while tasks:
+                tasks = self._collect_window_results(
+                    tasks, self._run_parallel(self._fetch_transactions_for_window, [task for _, task in tasks]), loaded
+                )
+            results, granularities = self._merge_window_results(windows, loaded)
+            if len(loaded) > 1:
+                total_processed = sum(processed for processed in results if processed is not None)
+                logger.info(f"Всего обработано транзакций за весь период: {total_processed}")
+            self._save_window_granularities(granularities)
+            self._mark_windows_completed('transactions', self._closed_windows(windows, results, now))
+            
+            # Агрегаты пересчитываем и при частичной загрузке: сохраненные страницы уже в БД
+            if windows:
+                self._refresh_spend_rollups(start_date, end_date)
             
-            # Если период большой (больше месяца), разбиваем на части
-            if (end_date - start_date).days > 30:
-                self._fetch_transactions_in_chunks(session, start_date, end_date)
+            # Водяной знак сдвигаем, только если все периоды успешно сохранены
+            if all(processed is not None for processed in results):
+                self._advance_watermark('transactions', end_date)
             else:
-                self._fetch_transactions_for_period(session, start_date, end_date)
+                logger.warning("Не все периоды транзакций загружены, водяной знак не сдвинут")
                 
         except Exception as e:
-            session.rollback()
             logger.error(f"Ошибка при сборе транзакций: {e}")
+            self._record_error('transactions', e)
+    
+    def _full_sync_start(self, now):
+        """Начало полной синхронизации: начало года, но не позже первого еще не закрытого месяца"""
+        # В начале года это захватывает конец прошлого года с его поздними корректировками
+        return min(datetime(now.year, 1, 1), month_start(now - self.close_after))
+    
+    def _plan_transactions_period(self, full_sync, watermark, period=None):
+        """Определить период (start, end) запроса транзакций"""
+        end_date = datetime.now()
+        
+        if period:
+            start_date, end_date = period[0], min(period[1], end_date)
+            logger.info(f"Синхронизация за период: запрос транзакций с {start_date.strftime('%Y-%m-%dT%H:%M:%S')} до {end_date.strftime('%Y-%m-%dT%H:%M:%S')}...")
+        elif full_sync:
+            # Полная синхронизация - запрашиваем с начала года (или с первого незакрытого месяца)
+            start_date = self._full_sync_start(end_date)
+            logger.info(f"Полная синхронизация: запрос транзакций с {start_date.strftime('%Y-%m-%dT%H:%M:%S')} до сейчас ({end_date.strftime('%Y-%m-%dT%H:%M:%S')})...")
+        elif watermark:
+            # Обычный режим - продолжаем с водяного знака с небольшим перекрытием
+            start_date = watermark - self.sync_overlap
+            logger.info(f"Обновление: запрос транзакций с водяного знака ({start_date.strftime('%Y-%m-%dT%H:%M:%S')}) до сейчас ({end_date.strftime('%Y-%m-%dT%H:%M:%S')})...")
+        else:
+            start_date = end_date - timedelta(hours=2)
+            logger.info(f"Обновление: водяной знак не найден, запрос транзакций за последние 2 часа ({start_date.strftime('%Y-%m-%dT%H:%M:%S')}) до сейчас ({end_date.strftime('%Y-%m-%dT%H:%M:%S')})...")
+        
+        return start_date, end_date
+    
+    def _refresh_spend_rollups(self, start_date, end_date):
+        """Пересчитать агрегаты расходов по услугам за затронутый период"""
+        session = create_session()
+        try:
+            refresh_spend_rollups(session, start_date, end_date)
+            session.commit()
+            logger.info(f"Агрегаты расходов по услугам обновлены за период {start_date.strftime('%Y-%m-%d')} - {end_date.strftime('%Y-%m-%d')}")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка при обновлении агрегатов расходов: {e}")
+            self._record_error('transactions', e)
+        finally:
+            session.close()
+    
+    def _get_watermark(self, stream):
+        """Прочитать водяной знак потока из sync_state"""
+        session = create_session()
+        try:
+            return get_sync_cursor(session, stream)
+        finally:
+            session.close()
+    
+    def _advance_watermark(self, stream, cursor):
+        """Сохранить водяной знак потока после успешной загрузки"""
+        session = create_session()
+        try:
+            advance_sync_cursor(session, stream, cursor)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    def _maintain_partitions(self):
+        """Создать секции на ближайшие месяцы и применить хранение снимков; ошибка не прерывает запуск"""
+        try:
+            maintain_partitions()
+        except Exception as e:
+            logger.error(f"Ошибка при обслуживании секций: {e}")
+    
+    def _ensure_partitions(self, table, start_date, end_date):
+        """Создать секции таблицы на загружаемый период (без них строки попадут в секцию по умолчанию)"""
+        try:
+            ensure_table_partitions(table, start_date, end_date)
+        except Exception as e:
+            logger.error(f"Ошибка при создании секций {table}: {e}")
+    
+    def _get_completed_windows(self, stream, start_date, end_date):
+        """Прочитать из sync_windows начала уже загруженных закрытых месяцев"""
+        session = create_session()
+        try:
+            return get_completed_windows(session, stream, month_start(start_date), end_date)
+        finally:
+            session.close()
+    
+    def _mark_windows_completed(self, stream, windows):
+        """Записать в sync_windows загруженные закрытые месяцы"""
+        if not windows:
+            return
+        session = create_session()
+        try:
+            mark_windows_completed(session, stream, windows)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка при сохранении загруженных окон {stream}: {e}")
         finally:
             session.close()
     
-    def _fetch_transactions_in_chunks(self, session, start_date, end_date):
-        """Запросить транзакции частями по месяцам для больших периодов"""
+    def _get_window_granularities(self, start_date, end_date):
+        """Прочитать сохраненную гранулярность окон транзакций по месяцам периода"""
+        session = create_session()
+        try:
+            return get_window_granularities(session, month_start(start_date), end_date)
+        finally:
+            session.close()
+    
+    def _save_window_granularities(self, granularities):
+        """Запомнить, с какой гранулярности начинать запросы транзакций за месяцы"""
+        if not granularities:
+            return
+        session = create_session()
+        try:
+            save_window_granularities(session, granularities)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка при сохранении гранулярности окон транзакций: {e}")
+        finally:
+            session.close()
+    
+    def _plan_transaction_tasks(self, windows, granularities):
+        """Разбить окна по сохраненной гранулярности месяца: [(индекс окна, TransactionWindowTask)]"""
+        tasks = []
+        for index, window in enumerate(windows):
+            granularity = granularities.get(month_start(window[0]), 'month')
+            tasks.extend(
+                (index, TransactionWindowTask(sub_window, granularity)) for sub_window in split_window(window, granularity)
+            )
+        return tasks
+    
+    def _split_transaction_task(self, task, first_page):
+        """Подокна для окна, первая страница которого заполнена до limit; [] - окно дробить не нужно"""
+        finer = finer_granularity(task.granularity)
+        sub_windows = split_window(task.window, finer) if finer else []
+        if len(sub_windows) < 2 or len(first_page) < TRANSACTIONS_PAGE_SIZE:
+            return []
+        start_date, end_date = task.window
+        logger.info(f"Окно {start_date.strftime('%Y-%m-%d %H:%M')} - {end_date.strftime('%Y-%m-%d %H:%M')} заполнено до лимита, дробление: {finer}")
+        # Первая страница окна - его первые элементы в порядке API; если все они попали в первое подокно,
+        # это и первая страница подокна, и повторно она не запрашивается
+        reused = first_page if page_fits_window(first_page, sub_windows[0]) else None
+        return [TransactionWindowTask(sub_windows[0], finer, reused)] + [
+            TransactionWindowTask(sub_window, finer) for sub_window in sub_windows[1:]
+        ]
+    
+    def _collect_window_results(self, tasks, task_results, loaded):
+        """Разобрать результаты раунда: загруженные окна - в loaded [(индекс, обработано или None, гранулярность)],
+        вернуть задачи следующего раунда (подокна раздробленных окон и повтор окон с ошибкой)"""
+        next_tasks = []
+        for (index, task), (processed, sub_tasks) in zip(tasks, task_results):
+            if sub_tasks:
+                next_tasks.extend((index, sub_task) for sub_task in sub_tasks)
+            elif processed is None and task.attempt < TRANSACTION_WINDOW_ATTEMPTS:
+                # Повторяется только окно с ошибкой, остальные окна месяца уже сохранены
+                next_tasks.append((index, task._replace(first_page=None, attempt=task.attempt + 1)))
+            else:
+                loaded.append((index, processed, task.granularity))
+        return next_tasks
+    
+    def _merge_window_results(self, windows, loaded):
+        """Свести результаты подокон к окнам: ([обработано или None], {начало месяца: гранулярность})"""
+        results = [0] * len(windows)
+        granularities = {}
+        for index, processed, granularity in loaded:
+            # Ошибка любого подокна означает, что окно загружено не полностью
+            results[index] = None if processed is None or results[index] is None else results[index] + processed
+            month = month_start(windows[index][0])
+            granularities[month] = finest_granularity(granularities.get(month, granularity), granularity)
+        return results, granularities
+    
+    def _transaction_window_failed(self, task, error):
+        """Записать ошибку окна транзакций; в журнал запуска попадает только ошибка последней попытки"""
+        start_date, end_date = task.window
+        message = f"Ошибка при сборе транзакций за период {start_date.strftime('%Y-%m-%d %H:%M')} - {end_date.strftime('%Y-%m-%d %H:%M')}: {error}"
+        if task.attempt < TRANSACTION_WINDOW_ATTEMPTS:
+            logger.warning(f"{message}; окно будет запрошено повторно")
+        else:
+            logger.error(message)
+            self._record_error('transactions', error)
+    
+    def _pending_windows(self, stream, windows, completed, force=False):
+        """Окна, месяц которых еще не заморожен (не отмечен в sync_windows); force - вернуть и замороженные"""
+        pending = [window for window in windows if month_start(window[0]) not in completed]
+        if force:
+            if len(pending) < len(windows):
+                logger.info(f"Поток {stream}: --force, повторно запрашиваются {len(windows) - len(pending)} замороженных месяцев")
+            return windows
+        if len(pending) < len(windows):
+            logger.info(f"Поток {stream}: пропущено {len(windows) - len(pending)} замороженных месяцев (закрыты и уже загружены)")
+        return pending
+    
+    def _is_closed_window(self, window, now):
+        """Окно покрывает календарный месяц целиком и месяц уже закрыт"""
+        start_date, end_date = window
+        return (
+            start_date == month_start(start_date)
+            and end_date == next_month_start(start_date)
+            and end_date <= now - self.close_after
+        )
+    
+    def _closed_windows(self, windows, results, now):
+        """Успешно загруженные закрытые окна [(start, end, строк)]; None/False в results - ошибка"""
+        closed = []
+        for window, result in zip(windows, results):
+            if result is None or result is False or not self._is_closed_window(window, now):
+                continue
+            closed.append((window[0], window[1], None if result is True else result))
+        return closed
+    
+    def _run_parallel(self, func, items):
+        """Выполнить func для каждого элемента в пуле потоков, сохранив порядок результатов"""
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, items))
+    
+    def _month_windows(self, start_date, end_date):
+        """Разбить период на окна по календарным месяцам"""
+        windows = []
         current_start = start_date
-        total_processed = 0
         
         while current_start < end_date:
             # Определяем конец текущего месяца или end_date, если он меньше
-            current_end = min(
-                datetime(current_start.year, current_start.month + 1, 1) if current_start.month < 12 
-                else datetime(current_start.year + 1, 1, 1),
-                end_date
-            )
-            
-            logger.info(f"Запрос транзакций за период: {current_start.strftime('%Y-%m-%d')} - {current_end.strftime('%Y-%m-%d')}")
-            processed = self._fetch_transactions_for_period(session, current_start, current_end)
-            total_processed += processed
-            
-            # Переходим к следующему месяцу
-            if current_start.month == 12:
-                current_start = datetime(current_start.year + 1, 1, 1)
-            else:
-                current_start = datetime(current_start.year, current_start.month + 1, 1)
+            next_month = next_month_start(current_start)
+            windows.append((current_start, min(next_month, end_date)))
+            current_start = next_month
         
-        logger.info(f"Всего обработано транзакций за весь период: {total_processed}")
+        return windows
     
-    def _fetch_transactions_for_period(self, session, start_date, end_date):
-        """Запросить транзакции за конкретный период"""
-        params = {
+    def _fetch_transactions_for_window(self, task):
+        """Загрузить окно транзакций (TransactionWindowTask) в отдельной сессии БД
+        
+        Возвращает (обработано, подокна): обработано - None при ошибке; подокна - задачи следующего раунда,
+        если окно пришлось раздробить (тогда в этом раунде ничего не сохраняется)
+        """
+        start_date, end_date = task.window
+        logger.info(f"Запрос транзакций за период: {start_date.strftime('%Y-%m-%d %H:%M')} - {end_date.strftime('%Y-%m-%d %H:%M')}")
+        
+        session = create_session()
+        try:
+            return self._fetch_transactions_adaptive(session, task)
+        except Exception as e:
+            session.rollback()
+            self._transaction_window_failed(task, e)
+            return None, []
+        finally:
+            session.close()
+    
+    def _fetch_transactions_adaptive(self, session, task):
+        """Загрузить окно; если первая страница заполнена до limit, вернуть подокна вместо загрузки"""
+        start_date, end_date = task.window
+        first_page = task.first_page
+        if first_page is None and finer_granularity(task.granularity):
+            # Первая страница (не больше TRANSACTIONS_PAGE_SIZE элементов) читается целиком, чтобы понять, влезает ли окно
+            first_page = list(self._iter_transaction_items(self._transactions_page_params(start_date, end_date, 0), {}))
+        sub_tasks = self._split_transaction_task(task, first_page) if first_page is not None else []
+        if sub_tasks:
+            return 0, sub_tasks
+        
+        # Окно мельче не дробится или помещается в одну страницу: дальше выручает offset-пагинация
+        return self._fetch_transactions_for_period(session, start_date, end_date, first_page), []
+    
+    def _transactions_page_params(self, start_date, end_date, offset):
+        """Параметры запроса страницы /v2/billing/transactions"""
+        return {
             'created_from': start_date.strftime('%Y-%m-%dT%H:%M:%S'),
             'created_to': end_date.strftime('%Y-%m-%dT%H:%M:%S'),
             'balances': 'main,vk_rub,bonus',
-            'offset': 0,
+            'offset': offset,
             'without_removed': 'true',
-            'limit': 500
+            'limit': TRANSACTIONS_PAGE_SIZE
         }
+    
+    def _iter_transaction_items(self, params, meta):
+        """Потоково получить транзакции одной страницы, не загружая ответ целиком"""
+        try:
+            yield from self.http.iter_json_items('/v2/billing/transactions', params, meta=meta)
+        except (requests.exceptions.RequestException, ijson.JSONError) as e:
+            raise RuntimeError(f"не удалось получить страницу транзакций (offset={params['offset']}): {e}")
+        if meta.get('status') != 'success':
+            raise RuntimeError(f"не удалось получить страницу транзакций (offset={params['offset']}): статус {meta.get('status')}")
+    
+    def _iter_transaction_batches(self, start_date, end_date, first_page=None):
+        """Постранично запросить транзакции за период и выдавать (номер страницы, пачка)
         
-        data = self.make_request('/v2/billing/transactions', params)
+        first_page - уже полученная первая страница периода, повторно она не запрашивается
+        """
+        # Элементы разбираются из потока ответа и отдаются пачками по UPSERT_BATCH_SIZE,
+        # поэтому в памяти держится только текущая пачка, независимо от размера периода
+        offset = 0
+        page_number = 0
         
-        if not data or data.get('status') != 'success':
-            logger.warning(f"Не удалось получить данные о транзакциях за период {start_date.strftime('%Y-%m-%d')} - {end_date.strftime('%Y-%m-%d')}")
-            return 0
-        
-        transactions_data = data.get('data', [])
-        processed_count = 0
-        updated_count = 0
-        
-        for transaction_data in transactions_data:
-            # Извлекаем необходимые поля
-            id_list = transaction_data.get('id_meta', {}).get('id', [])
-            if not id_list or not isinstance(id_list, list) or len(id_list) == 0:
-                logger.warning("Пропускаем транзакцию без ID")
-                continue
-            
-            # Берем минимальное значение из массива ID
-            transaction_id = min(id_list)
-            
-            # Проверяем, существует ли уже транзакция с таким ID
-            existing_transaction = session.query(Transaction).filter_by(id=transaction_id).first()
-            
-            # Извлекаем поля из server_meta.en
-            service_name = None
-            operation = None
-            service = None
-            server_meta = transaction_data.get('server_meta', {})
-            if isinstance(server_meta, dict) and 'en' in server_meta:
-                en_meta = server_meta['en']
-                service_name = en_meta.get('full_name')
-                operation = en_meta.get('operation')
-                service = en_meta.get('service')
-            
-            # Парсим дату создания
-            created_str = transaction_data.get('created')
-            created_date = None
-            if created_str:
-                try:
-                    created_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
-                except ValueError:
-                    logger.warning(f"Не удалось распарсить дату: {created_str}")
-                    created_date = datetime.utcnow()
-            
-            if existing_transaction:
-                # Обновляем существующую транзакцию
-                existing_transaction.transaction_type = transaction_data.get('transaction_type')
-                existing_transaction.transaction_group = transaction_data.get('transaction_group')
-                existing_transaction.balance = transaction_data.get('balance')
-                existing_transaction.price = float(transaction_data.get('price', 0))
-                existing_transaction.state = transaction_data.get('state')
-                existing_transaction.created = created_date
-                existing_transaction.service_name = service_name
-                existing_transaction.operation = operation
-                existing_transaction.service = service
-                existing_transaction.raw_data = transaction_data
-                existing_transaction.fetched_at = datetime.utcnow()
-                updated_count += 1
+        while True:
+            if first_page is not None and offset == 0:
+                items = first_page
             else:
-                # Создаем новую транзакцию
-                transaction = Transaction(
-                    id=transaction_id,
-                    transaction_type=transaction_data.get('transaction_type'),
-                    transaction_group=transaction_data.get('transaction_group'),
-                    balance=transaction_data.get('balance'),
-                    price=float(transaction_data.get('price', 0)),
-                    state=transaction_data.get('state'),
-                    created=created_date,
-                    service_name=service_name,
-                    operation=operation,
-                    service=service,
-                    raw_data=transaction_data
-                )
-                session.add(transaction)
+                items = self._iter_transaction_items(self._transactions_page_params(start_date, end_date, offset), {})
+            page_size = 0
+            batch = []
+            for item in items:
+                page_size += 1
+                batch.append(item)
+                if len(batch) >= UPSERT_BATCH_SIZE:
+                    yield page_number, batch
+                    batch = []
+            if batch:
+                yield page_number, batch
+            
+            # Неполная страница означает, что данные за период закончились
+            if page_size < TRANSACTIONS_PAGE_SIZE:
+                return
             
-            processed_count += 1
+            offset += page_size
+            page_number += 1
+    
+    def _fetch_transactions_for_period(self, session, start_date, end_date, first_page=None):
+        """Запросить транзакции за конкретный период (со всеми страницами)"""
+        started = time.monotonic()
+        pages_count = 0
+        processed_total = 0
+        updated_total = 0
+        unchanged_total = 0
         
+        for page_number, transactions_data in self._iter_transaction_batches(start_date, end_date, first_page):
+            processed, updated, unchanged = self._process_transactions_page(session, transactions_data)
+            pages_count = page_number + 1
+            processed_total += processed
+            updated_total += updated
+            unchanged_total += unchanged
+        
+        log_period_throughput(
+            start_date, end_date, processed_total, updated_total, unchanged_total, pages_count, time.monotonic() - started
+        )
+        return processed_total
+    
+    def _process_transactions_page(self, session, transactions_data):
+        """Сохранить пачку транзакций страницы, вернуть (обработано, обновлено, без изменений)"""
+        inserted_count, updated_count, unchanged_count = upsert_transactions(session, parse_transactions(transactions_data))
         session.commit()
-        logger.info(f"Обработано {processed_count} транзакций за период: {processed_count - updated_count} новых, {updated_count} обновлено")
-        return processed_count
+        self._record_rows('transactions', inserted_count, updated_count, unchanged_count)
+        return inserted_count + updated_count + unchanged_count, updated_count, unchanged_count
 
-    def fetch_project_reports(self, full_sync=False):
-        """Получить отчеты по проектам за текущий год"""
-        current_year = datetime.now().year
-        current_month = datetime.now().month
+    def backfill_transactions(self, start_date, end_date):
+        """Загрузить транзакции за произвольный период через COPY во временную таблицу и один upsert на месяц"""
+        end_date = min(end_date, datetime.now())
+        windows = self._month_windows(start_date, end_date)
+        logger.info(f"Загрузка истории транзакций за {start_date.strftime('%Y-%m-%d')} - {end_date.strftime('%Y-%m-%d')}: {len(windows)} мес., потоков: {self.max_workers}")
+        
+        self.http.stats.reset()
+        self.ledger = self.ledger_class('backfill', True)
+        self.ledger.start()
+        self._ensure_partitions('transactions', start_date, end_date)
+        try:
+            with self.ledger.stage('transactions'):
+                results = self._run_parallel(self._backfill_window, windows)
+                total_processed = sum(processed for processed in results if processed is not None)
+                logger.info(f"Всего загружено транзакций за период: {total_processed}")
+                
+                self._refresh_spend_rollups(start_date, end_date)
+                # Водяной знак только продвигается вперед, поэтому загрузка старых лет его не откатит
+                if all(processed is not None for processed in results):
+                    self._advance_watermark('transactions', end_date)
+                else:
+                    logger.warning("Не все месяцы истории загружены, водяной знак не сдвинут")
+        finally:
+            self.http.stats.log()
+            self.ledger.finish(self.http.stats.snapshot())
+    
+    def _backfill_window(self, window):
+        """Загрузить окно (start, end) через COPY и слить в transactions одним запросом, None - при ошибке"""
+        start_date, end_date = window
+        started = time.monotonic()
+        pages_count = 0
         
         session = create_session()
         try:
-            # Определяем, за какие месяцы нужно запрашивать данные
-            months_to_fetch = []
+            # Временная таблица живет до COMMIT: окно загружается в одной транзакции
+            create_transactions_stage(session)
+            for page_number, transactions_data in self._iter_transaction_batches(start_date, end_date):
+                copy_transactions(session, parse_transactions(transactions_data))
+                pages_count = page_number + 1
+            inserted_count, updated_count, unchanged_count = merge_transactions_stage(session)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка при загрузке истории транзакций за период {start_date.strftime('%Y-%m-%d')} - {end_date.strftime('%Y-%m-%d')}: {e}")
+            self._record_error('transactions', e)
+            return None
+        finally:
+            session.close()
+        
+        processed = inserted_count + updated_count + unchanged_count
+        self._record_rows('transactions', inserted_count, updated_count, unchanged_count)
+        log_period_throughput(start_date, end_date, processed, updated_count, unchanged_count, pages_count, time.monotonic() - started)
+        # Закрытый месяц заморожен сразу после слияния, как в fetch_transactions: следующая полная
+        # синхронизация его не запрашивает, даже если другие месяцы истории не загрузились
+        self._mark_windows_completed('transactions', self._closed_windows([window], [processed], datetime.now()))
+        return processed
+
+    def fetch_project_reports(self, full_sync=False, period=None, force=False):
+        """Получить отчеты по проектам за период, с начала года или за месяцы с последнего водяного знака (force - и замороженные)"""
+        now = datetime.now()
+        
+        try:
+            watermark = None if full_sync or period else self._get_watermark('project_reports')
+            windows = self._plan_project_report_windows(full_sync, watermark, now, period)
+            windows = self._pending_windows(
+                'project_reports', windows, self._get_completed_windows('project_reports', windows[0][0], windows[-1][1]), force
+            )
             
-            if full_sync:
-                # Полная синхронизация - запрашиваем все месяцы с начала года
-                months_to_fetch = list(range(1, current_month + 1))
-                logger.info(f"Полная синхронизация отчетов по проектам за {current_year} год (месяцы: {months_to_fetch})...")
+            results = self._run_parallel(self._fetch_project_report_in_session, [(start.year, start.month) for start, _ in windows])
+            self._mark_windows_completed('project_reports', self._closed_windows(windows, results, now))
+            if all(results):
+                self._advance_watermark('project_reports', now)
             else:
-                # Обычный режим - запрашиваем ТОЛЬКО текущий месяц
-                months_to_fetch = [current_month]
-                logger.info(f"Обновление отчетов по проектам за {current_year} год (только текущий месяц: {current_month})...")
-            
-            for month in months_to_fetch:
-                self._fetch_project_report_for_month(session, current_year, month)
+                logger.warning("Не все месяцы отчетов по проектам загружены, водяной знак не сдвинут")
                 
         except Exception as e:
-            session.rollback()
             logger.error(f"Ошибка при сборе отчетов по проектам: {e}")
+            self._record_error('project_reports', e)
+    
+    def _plan_project_report_windows(self, full_sync, watermark, now, period=None):
+        """Определить месяцы [(начало, конец)], за которые нужно запрашивать отчеты по проектам"""
+        if period:
+            start_date, end_date = period[0], min(period[1], now)
+            mode = "Синхронизация отчетов по проектам за период"
+        elif full_sync:
+            # Полная синхронизация - все месяцы с начала года (или с первого незакрытого месяца)
+            start_date, end_date = self._full_sync_start(now), now
+            mode = "Полная синхронизация отчетов по проектам"
+        else:
+            # Обычный режим - текущий месяц и все месяцы, пропущенные с водяного знака
+            start_date, end_date = (watermark - self.sync_overlap if watermark else month_start(now)), now
+            mode = "Обновление отчетов по проектам"
+        
+        # Отчет запрашивается за месяц целиком, поэтому окна выравниваются по границам месяцев
+        windows = [
+            (month_start(window_start), next_month_start(window_start))
+            for window_start, _ in self._month_windows(start_date, end_date)
+        ] or [(month_start(now), next_month_start(now))]
+        logger.info(f"{mode} за месяцы: {', '.join(f'{start.month}/{start.year}' for start, _ in windows)}...")
+        return windows
+    
+    def _fetch_project_report_in_session(self, period):
+        """Получить отчет по проектам за (year, month) в отдельной сессии БД"""
+        year, month = period
+        session = create_session()
+        try:
+            return self._fetch_project_report_for_month(session, year, month)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Ошибка при сборе отчетов по проектам за {month}/{year}: {e}")
+            self._record_error('project_reports', e)
+            return False
         finally:
             session.close()
     
@@ -302,76 +729,66 @@ class SelectelETL:
         
         if not data or data.get('status') != 'success':
             logger.warning(f"Не удалось получить данные по проектам за {month}/{year}")
-            return
-        
-        report_data = data.get('data', {})
-        projects = report_data.get('projects', [])
-        
-        processed_count = 0
-        updated_count = 0
-        
-        for project in projects:
-            project_name = project.get('name')
-            if not project_name:
-                continue
-                
-            paid_by_balance = project.get('paid_by_balance', [])
-            
-            for balance_info in paid_by_balance:
-                balance_type = balance_info.get('balance')
-                value = balance_info.get('value', 0)
-                
-                if not balance_type:
-                    continue
-                
-                # Проверяем, существует ли уже запись
-                existing_report = session.query(ProjectReport).filter_by(
-                    year=year,
-                    month=month,
-                    project_name=project_name,
-                    balance_type=balance_type
-                ).first()
-                
-                if existing_report:
-                    # Обновляем существующую запись
-                    existing_report.value = float(value)
-                    existing_report.raw_data = project
-                    existing_report.fetched_at = datetime.utcnow()
-                    updated_count += 1
-                else:
-                    # Создаем новую запись
-                    project_report = ProjectReport(
-                        year=year,
-                        month=month,
-                        project_name=project_name,
-                        balance_type=balance_type,
-                        value=float(value),
-                        raw_data=project
-                    )
-                    session.add(project_report)
-                
-                processed_count += 1
+            self._record_error('project_reports', f"нет данных за {month}/{year}")
+            return False
         
+        inserted_count, updated_count, unchanged_count = upsert_project_reports(session, parse_project_report(data, year, month))
         session.commit()
-        logger.info(f"Обработано {processed_count} записей по проектам за {month}/{year}: {processed_count - updated_count} новых, {updated_count} обновлено")
+        self._record_rows('project_reports', inserted_count, updated_count, unchanged_count)
+        logger.info(
+            f"Обработано {inserted_count + updated_count + unchanged_count} записей по проектам за {month}/{year}: "
+            f"{inserted_count} новых, {updated_count} обновлено, {unchanged_count} без изменений"
+        )
+        return True
 
-    def run_etl(self, full_sync=False):
-        """Запустить полный ETL-процесс"""
-        logger.info("Начало ETL-процесса")
+    def run_etl(self, full_sync=False, period=None, streams=None, force=False):
+        """Запустить ETL-процесс (period - явный период (start, end) для транзакций и отчетов, streams - только эти потоки,
+        force - повторно запросить замороженные месяцы)"""
+        streams = STREAMS if streams is None else streams
+        logger.info("Начало ETL-процесса" if set(streams) == set(STREAMS) else f"Начало ETL-процесса: {', '.join(streams)}")
         start_time = datetime.now()
+        self.http.stats.reset()
+        self.ledger = self.ledger_class('sync', full_sync)
+        self.ledger.start()
+        self._maintain_partitions()
         
+        stages = {
+            'balances': self.fetch_balances,
+            'predictions': self.fetch_predictions,
+            'transactions': lambda: self.fetch_transactions(full_sync=full_sync, period=period, force=force),
+            'project_reports': lambda: self.fetch_project_reports(full_sync=full_sync, period=period, force=force)
+        }
         try:
-            self.fetch_balances()
-            self.fetch_predictions()
-            self.fetch_transactions(full_sync=full_sync)
-            self.fetch_project_reports(full_sync=full_sync)
+            for stream in STREAMS:
+                if stream in streams:
+                    with self.ledger.stage(stream):
+                        stages[stream]()
             
             end_time = datetime.now()
             duration = (end_time - start_time).total_seconds()
             logger.info(f"ETL-процесс завершен за {duration:.2f} секунд")
+            self.http.stats.log()
             
         except Exception as e:
             logger.error(f"Критическая ошибка в ETL-процессе: {e}")
+        finally:
+            self.ledger.finish(self.http.stats.snapshot())
+
+def parse_period_bound(value, upper=False):
+    """Граница периода --from/--to/--backfill: YYYY, YYYY-MM или YYYY-MM-DD (верхняя включается целиком)"""
+    parts = value.split('-')
+    # int() принял бы и ' 1', и '+1', а datetime(*parts) - лишний четвертый компонент как час
+    if len(parts) > 3 or not all(part.isascii() and part.isdigit() for part in parts):
+        raise ValueError(f"'{value}': ожидается YYYY, YYYY-MM или YYYY-MM-DD")
+    parts = [int(part) for part in parts]
+    start = datetime(*parts, *[1] * (3 - len(parts)))
+    if not upper:
+        return start
+    if len(parts) == 1:
+        return datetime(start.year + 1, 1, 1)
+    if len(parts) == 2:
+        return next_month_start(start)
+    return start + timedelta(days=1)
 
 def main():
     """Основная функция для запуска ETL"""
@@ -379,42 +796,129 @@ def main():
     
     parser = argparse.ArgumentParser(description='Selectel Billing ETL')
     parser.add_argument('--run-once', action='store_true', help='Запустить ETL один раз и завершить')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Использовать асинхронный движок (aiohttp + asyncpg)')
+    parser.add_argument('--compact-raw-data', action='store_true',
+                        help='Перенести raw_data существующих записей в архив raw_payloads и завершить')
+    parser.add_argument('--partition-tables', action='store_true',
+                        help='Перевести transactions, balances и predictions на помесячные секции и завершить (ETL должен быть остановлен)')
+    parser.add_argument('--backfill', nargs=2, metavar=('FROM', 'TO'),
+                        help='Загрузить историю транзакций через COPY за период (YYYY, YYYY-MM или YYYY-MM-DD) и завершить')
+    parser.add_argument('--from', dest='period_from', metavar='FROM',
+                        help='Однократная синхронизация транзакций и отчетов за период с FROM (YYYY, YYYY-MM или YYYY-MM-DD)')
+    parser.add_argument('--to', dest='period_to', metavar='TO',
+                        help='Конец периода для --from включительно (по умолчанию - сейчас)')
+    parser.add_argument('--force', action='store_true',
+                        help='Повторно запросить замороженные месяцы (закрытые более SYNC_CLOSE_AFTER_DAYS дней назад и уже загруженные)')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Вывести время импортов и инициализации и завершить (API не вызывается)')
     args = parser.parse_args()
     
+    period = None
+    if args.period_to and not args.period_from:
+        parser.error("--to используется только вместе с --from")
+    if args.period_from:
+        try:
+            period = (
+                parse_period_bound(args.period_from),
+                parse_period_bound(args.period_to, upper=True) if args.period_to else datetime.now()
+            )
+        except ValueError as e:
+            parser.error(f"некорректный период --from/--to: {e}")
+        if period[0] >= period[1]:
+            parser.error("начало периода --from должно быть раньше конца")
+    
+    if args.backfill:
+        try:
+            backfill_from = parse_period_bound(args.backfill[0])
+            backfill_to = parse_period_bound(args.backfill[1], upper=True)
+        except ValueError as e:
+            parser.error(f"некорректный период --backfill: {e}")
+        if backfill_from >= backfill_to:
+            parser.error("начало периода --backfill должно быть раньше конца")
+    
     # Настройка логирования
-    logger.add(
-        "logs/selectel_etl.log",
-        rotation="1 day",
-        retention="30 days",
-        level=os.getenv('LOG_LEVEL', 'INFO')
-    )
+    with startup_profile.phase('настройка логирования'):
+        logger.add(
+            "logs/selectel_etl.log",
+            rotation="1 day",
+            retention="30 days",
+            level=os.getenv('LOG_LEVEL', 'INFO')
+        )
     
+    etl = None
     try:
-        etl = SelectelETL()
+        if args.compact_raw_data:
+            # Одноразовая миграция старых записей в архив исходных ответов
+            init_database()
+            compact_raw_data()
+            return
+        
+        if args.partition_tables:
+            # Одноразовая миграция существующих таблиц на помесячные секции
+            init_database()
+            partition_existing_tables()
+            return
+        
+        if args.backfill:
+            # COPY доступен только через psycopg2, поэтому история грузится синхронным движком
+            etl = SelectelETL()
+            etl.backfill_transactions(backfill_from, backfill_to)
+            return
         
-        if args.run_once:
+        if args.use_async:
+            with startup_profile.phase('импорт async_etl'):
+                from async_etl import AsyncSelectelETL
+            etl = AsyncSelectelETL()
+        else:
+            etl = SelectelETL()
+        
+        if args.profile_startup:
+            # Обслуживание секций выполняется в начале каждого запуска, поэтому тоже входит в профиль
+            with startup_profile.phase('обслуживание секций'):
+                etl._maintain_partitions()
+            startup_profile.print_report()
+            return
+        
+        if period:
+            # Однократная синхронизация за явно заданный период
+            etl.run_etl(period=period, force=args.force)
+            logger.info("ETL-процесс завершен (синхронизация за период)")
+        elif args.run_once:
             # Однократный запуск с полной синхронизацией
-            etl.run_etl(full_sync=True)
+            etl.run_etl(full_sync=True, force=args.force)
             logger.info("ETL-процесс завершен (однократный запуск)")
         else:
-            # Запуск по расписанию
-            interval_hours = int(os.getenv('ETL_INTERVAL_HOURS', 1))
-            schedule.every(interval_hours).hours.do(etl.run_etl)
+            # Запуск по расписанию: у каждого потока свое cron-выражение (SCHEDULE_<ПОТОК>).
+            # Планировщик и HTTP-сервер метрик нужны только демону, однократные запуски их не импортируют
+            from metrics import start_metrics_server
+            from scheduler import StreamScheduler, load_schedules
+            schedules = load_schedules(STREAMS)
+            if os.getenv('ETL_INTERVAL_HOURS'):
+                logger.warning("ETL_INTERVAL_HOURS больше не используется: расписание задается SCHEDULE_<ПОТОК>")
             
-            # Первый запуск сразу с полной синхронизацией
-            etl.run_etl(full_sync=True)
+            metrics_port = int(os.getenv('METRICS_PORT', 0))
+            if metrics_port:
+                start_metrics_server(metrics_port, os.getenv('METRICS_HOST', '0.0.0.0'))
             
-            logger.info(f"ETL-система запущена с интервалом {interval_hours} час(ов)")
+            # Первый запуск сразу с полной синхронизацией
+            etl.run_etl(full_sync=True, force=args.force)
             
-            # Бесконечный цикл для работы по расписанию
-            while True:
-                schedule.run_pending()
-                time.sleep(60)  # Проверка каждую минуту
+            scheduler = StreamScheduler(lambda streams: etl.run_etl(streams=streams), schedules)
+            # docker stop посылает SIGTERM: планировщик просыпается и завершается, не дожидаясь следующего запуска
+            signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+            logger.info("ETL-система запущена по расписанию потоков")
+            scheduler.run_forever()
+            logger.info("ETL-система остановлена")
                 
     except KeyboardInterrupt:
         logger.info("ETL-система остановлена пользователем")
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
+    finally:
+        if etl is not None:
+            etl.close()
+        dispose_engine()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""
+Профиль холодного старта ETL (--profile-startup): время импортов по пакетам и этапов инициализации
+"""
+
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+
+_original_import = builtins.__import__
+_enabled = False
+_started = None
+# Собственное время импорта по корневым пакетам (без вложенных импортов других пакетов)
+_import_seconds = {}
+# Стек импортов [корневой пакет, момент начала текущего отрезка]
+_import_stack = []
+_phases = []
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Уже загруженные модули и относительные импорты учитываются в пакете, который их импортирует
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    now = time.perf_counter()
+    if _import_stack:
+        parent = _import_stack[-1]
+        _import_seconds[parent[0]] = _import_seconds.get(parent[0], 0.0) + now - parent[1]
+    root = name.partition('.')[0]
+    _import_stack.append([root, now])
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        now = time.perf_counter()
+        _import_seconds[root] = _import_seconds.get(root, 0.0) + now - _import_stack.pop()[1]
+        if _import_stack:
+            _import_stack[-1][1] = now
+
+
+def enable():
+    """Включить профиль: дальнейшие импорты и этапы phase() замеряются"""
+    global _enabled, _started
+    if _enabled:
+        return
+    _enabled = True
+    _started = time.perf_counter()
+    builtins.__import__ = _timed_import
+
+
+@contextmanager
+def phase(name):
+    """Замерить этап инициализации; без --profile-startup ничего не делает"""
+    if not _enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - started))
+
+
+def print_report(min_import_ms=5.0):
+    """Вывести разбивку времени старта и снять хук импортов"""
+    builtins.__import__ = _original_import
+    total = time.perf_counter() - _started
+    imports_total = sum(_import_seconds.values())
+
+    print("\n⏱ Профиль запуска ETL")
+    print(f"{'этап':<40}{'время, мс':>12}")
+    print(f"{'импорты':<40}{imports_total * 1000:>12.1f}")
+    other = 0.0
+    for root, seconds in sorted(_import_seconds.items(), key=lambda item: item[1], reverse=True):
+        if seconds * 1000 < min_import_ms:
+            other += seconds
+            continue
+        print(f"{'  ' + root:<40}{seconds * 1000:>12.1f}")
+    if other:
+        print(f"{'  прочие':<40}{other * 1000:>12.1f}")
+
+    print("инициализация")
+    for name, seconds in _phases:
+        print(f"{'  ' + name:<40}{seconds * 1000:>12.1f}")
+    print(f"{'всего с начала импортов':<40}{total * 1000:>12.1f}")
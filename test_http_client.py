@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Тесты HTTP-клиента: потоковый разбор элементов ответа, задержки повторов по Retry-After и бэкоффу (без сети)
+"""
+
+import io
+import os
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import mock
+import ijson
+from loguru import logger
+from http_client import JSONItemCollector, RetryPolicy
+
+
+def collect(document, prefix='data'):
+    """Разобрать JSON-документ так же, как ответ API: вернуть (элементы, meta)"""
+    items, meta = [], {}
+    collector = JSONItemCollector(prefix, meta)
+    for path, event, value in ijson.parse(io.BytesIO(document), use_float=True):
+        done, item = collector.feed(path, event, value)
+        if done:
+            items.append(item)
+    return items, meta
+
+
+class JSONItemCollectorTest(unittest.TestCase):
+    def test_nested_items(self):
+        document = b'''{"data": [
+            {"id": 1, "amount": 1.5, "tags": ["a", "b"], "service": {"name": "vpc", "ids": [{"x": null}]}},
+            {"id": 2, "amount": null, "tags": [], "service": {}}
+        ]}'''
+        items, _ = collect(document)
+        self.assertEqual(items, [
+            {'id': 1, 'amount': 1.5, 'tags': ['a', 'b'], 'service': {'name': 'vpc', 'ids': [{'x': None}]}},
+            {'id': 2, 'amount': None, 'tags': [], 'service': {}},
+        ])
+
+    def test_scalar_and_array_items(self):
+        items, _ = collect(b'{"data": [1, null, "x", true, [1, [2]], {}]}')
+        self.assertEqual(items, [1, None, 'x', True, [1, [2]], {}])
+
+    def test_numbers_are_floats(self):
+        items, _ = collect(b'{"data": [{"amount": 0.1}]}')
+        self.assertIsInstance(items[0]['amount'], float)
+
+    def test_meta_is_top_level_scalars_only(self):
+        document = b'''{"status": "success", "data": [{"id": 1}],
+            "paginator": {"total": 10}, "count": 1, "extra": [1, 2]}'''
+        items, meta = collect(document)
+        self.assertEqual(items, [{'id': 1}])
+        # статус после data тоже попадает в meta; вложенные объекты и массивы - нет
+        self.assertEqual(meta, {'status': 'success', 'count': 1})
+
+    def test_null_and_empty_data(self):
+        self.assertEqual(collect(b'{"status": "success", "data": null}'), ([], {'status': 'success', 'data': None}))
+        self.assertEqual(collect(b'{"data": []}'), ([], {}))
+        self.assertEqual(collect(b'{"status": "error"}'), ([], {'status': 'error'}))
+
+    def test_nested_prefix(self):
+        document = b'{"status": "success", "data": {"total": 2, "items": [{"id": 1}, {"id": 2}]}}'
+        items, meta = collect(document, prefix='data.items')
+        self.assertEqual(items, [{'id': 1}, {'id': 2}])
+        self.assertEqual(meta, {'status': 'success'})
+
+
+class RetryAfterTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.dict(os.environ, {'HTTP_RETRY_AFTER_MAX': '300', 'HTTP_MAX_RETRIES': '3'}):
+            self.policy = RetryPolicy()
+        self.warnings = []
+        handler = logger.add(self.warnings.append, level='WARNING')
+        self.addCleanup(logger.remove, handler)
+
+    def retry_after(self, value):
+        return self.policy.retry_after({'Retry-After': value})
+
+    def test_seconds(self):
+        self.assertEqual(self.retry_after('5'), 5.0)
+        self.assertEqual(self.retry_after('0.5'), 0.5)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(self.policy.retry_after({}))
+        self.assertIsNone(self.retry_after(''))
+        self.assertIsNone(self.retry_after('soon'))
+        self.assertIsNone(self.retry_after('nan'))
+
+    def test_negative_is_zero(self):
+        self.assertEqual(self.retry_after('-3'), 0.0)
+
+    def test_http_date(self):
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+        self.assertAlmostEqual(self.retry_after(format_datetime(retry_at, usegmt=True)), 30, delta=2)
+
+    def test_http_date_without_zone_is_gmt(self):
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+        value = retry_at.strftime('%a, %d %b %Y %H:%M:%S')
+        self.assertAlmostEqual(self.retry_after(value), 30, delta=2)
+        self.assertAlmostEqual(self.retry_after(f"{value} -0000"), 30, delta=2)
+
+    def test_http_date_in_past(self):
+        self.assertEqual(self.retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+
+    def test_capped_with_warning(self):
+        self.assertEqual(self.retry_after('3600'), 300.0)
+        self.assertEqual(self.retry_after('inf'), 300.0)
+        self.assertEqual(len(self.warnings), 2)
+        self.assertIn('HTTP_RETRY_AFTER_MAX', str(self.warnings[0]))
+
+    def test_not_capped_without_warning(self):
+        self.assertEqual(self.retry_after('300'), 300.0)
+        self.assertEqual(self.warnings, [])
+
+
+class RetryDelayTest(unittest.TestCase):
+    def setUp(self):
+        env = {'HTTP_MAX_RETRIES': '3', 'HTTP_BACKOFF_BASE': '1', 'HTTP_BACKOFF_MAX': '4'}
+        with mock.patch.dict(os.environ, env):
+            self.policy = RetryPolicy()
+
+    def test_not_retried_status(self):
+        self.assertIsNone(self.policy.retry_delay(404, {}, 0))
+
+    def test_retries_exhausted(self):
+        self.assertIsNone(self.policy.retry_delay(503, {'Retry-After': '1'}, 3))
+
+    def test_retry_after_wins_over_backoff(self):
+        self.assertEqual(self.policy.retry_delay(429, {'Retry-After': '7'}, 0), 7.0)
+
+    def test_backoff_bounds(self):
+        for attempt, bound in ((0, 1), (1, 2), (2, 4)):
+            for _ in range(20):
+                self.assertTrue(0 <= self.policy.retry_delay(503, {}, attempt) <= bound)
+        # Верхняя граница бэкоффа - HTTP_BACKOFF_MAX
+        self.assertTrue(all(self.policy.backoff_delay(10) <= 4 for _ in range(20)))
+
+
+if __name__ == '__main__':
+    unittest.main()
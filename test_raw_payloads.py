@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Тесты архива исходных ответов: хеширование, сжатие и чтение документа по хешу (без БД)
+"""
+
+import unittest
+from unittest import mock
+import raw_payloads
+from models import RawPayload
+
+
+class FakeSession:
+    """Сессия, которая хранит вставленные в raw_payloads строки в памяти"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def execute(self, statement, records):
+        for record in records:
+            self.rows.setdefault(record['hash'], RawPayload(**record))
+
+    def get(self, model, key):
+        return self.rows.get(key)
+
+
+class RawPayloadArchiveTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(raw_payloads, 'RAW_RETENTION_STREAMS', {'transactions'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        session = FakeSession()
+        payload = {'id_meta': {'id': [687288652]}, 'price': '-12.5', 'server_meta': {'en': {'full_name': 'Сервер'}}}
+        [hash_value] = raw_payloads.archive_payloads(session, 'transactions', [payload])
+
+        self.assertEqual(hash_value, raw_payloads.payload_hash(payload))
+        self.assertEqual(session.rows[hash_value].codec, raw_payloads.CODEC)
+        self.assertEqual(raw_payloads.load_raw_payload(session, hash_value), payload)
+
+    def test_key_order_does_not_change_hash(self):
+        self.assertEqual(raw_payloads.payload_hash({'a': 1, 'b': 2}), raw_payloads.payload_hash({'b': 2, 'a': 1}))
+
+    def test_identical_payloads_stored_once(self):
+        session = FakeSession()
+        hashes = raw_payloads.archive_payloads(session, 'transactions', [{'x': 1}, {'x': 1}, None])
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertIsNone(hashes[2])
+        self.assertEqual(len(session.rows), 1)
+
+    def test_disabled_stream_is_not_archived(self):
+        session = FakeSession()
+        self.assertEqual(raw_payloads.archive_payloads(session, 'balances', [{'x': 1}]), [None])
+        self.assertEqual(session.rows, {})
+
+    def test_missing_payload(self):
+        self.assertIsNone(raw_payloads.load_raw_payload(FakeSession(), 'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Тесты планировщика потоков: разбор cron-выражений, поиск ближайшего момента и пропуск моментов (без БД и API)
+"""
+
+import os
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from scheduler import CronExpression, StreamSchedule, load_schedules
+
+
+class CronNextAfterTest(unittest.TestCase):
+    def assertNext(self, expression, after, expected):
+        self.assertEqual(CronExpression(expression).next_after(after), expected)
+
+    def test_step(self):
+        self.assertNext('*/15 * * * *', datetime(2026, 10, 17, 10, 7, 30), datetime(2026, 10, 17, 10, 15))
+
+    def test_strictly_after(self):
+        self.assertNext('*/15 * * * *', datetime(2026, 10, 17, 10, 15), datetime(2026, 10, 17, 10, 30))
+
+    def test_hour_step(self):
+        self.assertNext('30 */6 * * *', datetime(2026, 10, 17, 7, 0), datetime(2026, 10, 17, 12, 30))
+
+    def test_year_rollover(self):
+        self.assertNext('0 0 1 * *', datetime(2026, 12, 15), datetime(2027, 1, 1))
+
+    def test_leap_day(self):
+        self.assertNext('0 0 29 2 *', datetime(2026, 3, 1), datetime(2028, 2, 29))
+
+    def test_sunday_as_seven(self):
+        # 2026-10-17 - суббота
+        self.assertNext('0 0 * * 7', datetime(2026, 10, 17), datetime(2026, 10, 18))
+
+    def test_never(self):
+        with self.assertRaises(ValueError):
+            CronExpression('0 0 30 2 *').next_after(datetime(2026, 10, 17))
+
+
+class CronDayMatchingTest(unittest.TestCase):
+    def test_day_or_weekday_when_both_restricted(self):
+        cron = CronExpression('0 0 13 * 5')
+        # пятница, не 13-е
+        self.assertEqual(cron.next_after(datetime(2026, 10, 17)), datetime(2026, 10, 23))
+        # 13-е, воскресенье
+        self.assertEqual(cron.next_after(datetime(2026, 12, 11)), datetime(2026, 12, 13))
+
+    def test_star_step_is_not_a_restriction(self):
+        # '*/2' начинается со '*': нужны и нечетный день, и пятница (а не любой нечетный день, как 19-е)
+        self.assertEqual(CronExpression('0 0 */2 * 5').next_after(datetime(2026, 10, 17)), datetime(2026, 10, 23))
+
+    def test_weekday_only(self):
+        self.assertEqual(CronExpression('0 0 * * 5').next_after(datetime(2026, 10, 17)), datetime(2026, 10, 23))
+
+
+class CronParsingTest(unittest.TestCase):
+    def test_aliases(self):
+        after = datetime(2026, 10, 17, 10, 7)
+        self.assertEqual(CronExpression('@hourly').next_after(after), datetime(2026, 10, 17, 11, 0))
+        self.assertEqual(CronExpression('@daily').next_after(after), datetime(2026, 10, 18))
+        self.assertEqual(CronExpression('@weekly').next_after(after), datetime(2026, 10, 18))
+        self.assertEqual(CronExpression('@monthly').next_after(after), datetime(2026, 11, 1))
+
+    def test_lists_and_ranges(self):
+        cron = CronExpression('0,30 9-11 * * 1-5')
+        self.assertEqual(cron.hours, {9, 10, 11})
+        self.assertEqual(cron.minutes, {0, 30})
+        self.assertEqual(cron.weekdays, {1, 2, 3, 4, 5})
+
+    def test_invalid(self):
+        for expression in ('61 * * * *', '* * *', '5-1 * * * *', '*/0 * * * *', '0 0 0 * *', '@yearly'):
+            with self.subTest(expression=expression), self.assertRaises(ValueError):
+                CronExpression(expression)
+
+
+class StreamSchedulePlanTest(unittest.TestCase):
+    def test_no_skip_when_run_finishes_in_time(self):
+        schedule = StreamSchedule('balances', CronExpression('*/15 * * * *'))
+        self.assertEqual(schedule.plan(datetime(2026, 10, 17, 10, 7)), 0)
+        self.assertEqual(schedule.next_run, datetime(2026, 10, 17, 10, 15))
+        self.assertEqual(schedule.plan(datetime(2026, 10, 17, 10, 16)), 0)
+        self.assertEqual(schedule.next_run, datetime(2026, 10, 17, 10, 30))
+
+    def test_skipped_ticks_are_counted(self):
+        schedule = StreamSchedule('balances', CronExpression('*/15 * * * *'))
+        schedule.plan(datetime(2026, 10, 17, 10, 7))
+        # запуск в 10:15 закончился в 10:52: моменты 10:30 и 10:45 пропущены
+        self.assertEqual(schedule.plan(datetime(2026, 10, 17, 10, 52)), 2)
+        self.assertEqual(schedule.next_run, datetime(2026, 10, 17, 11, 0))
+
+    def test_jitter_delays_run_but_not_tick(self):
+        schedule = StreamSchedule('balances', CronExpression('0 * * * *'), jitter_seconds=30)
+        schedule.plan(datetime(2026, 10, 17, 10, 7))
+        self.assertEqual(schedule.tick, datetime(2026, 10, 17, 11, 0))
+        self.assertTrue(schedule.tick <= schedule.next_run <= schedule.tick + timedelta(seconds=30))
+
+
+class LoadSchedulesTest(unittest.TestCase):
+    def test_env_overrides_and_disables(self):
+        env = {'SCHEDULE_BALANCES': '@hourly', 'SCHEDULE_PREDICTIONS': ''}
+        with mock.patch.dict(os.environ, env):
+            schedules = load_schedules(('balances', 'predictions', 'transactions'), jitter_seconds=0)
+        self.assertEqual([schedule.stream for schedule in schedules], ['balances', 'transactions'])
+        self.assertEqual(schedules[0].cron.expression, '@hourly')
+        self.assertEqual(schedules[1].cron.expression, '0 * * * *')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Тесты разбора границ периода --from/--to/--backfill (без БД и API)
+"""
+
+import unittest
+from datetime import datetime
+from selectel_etl import parse_period_bound
+
+
+class ParsePeriodBoundTest(unittest.TestCase):
+    def test_lower_bound(self):
+        self.assertEqual(parse_period_bound('2024'), datetime(2024, 1, 1))
+        self.assertEqual(parse_period_bound('2024-03'), datetime(2024, 3, 1))
+        self.assertEqual(parse_period_bound('2024-3'), datetime(2024, 3, 1))
+        self.assertEqual(parse_period_bound('2024-03-15'), datetime(2024, 3, 15))
+
+    def test_upper_bound_includes_whole_period(self):
+        self.assertEqual(parse_period_bound('2024', upper=True), datetime(2025, 1, 1))
+        self.assertEqual(parse_period_bound('2024-03', upper=True), datetime(2024, 4, 1))
+        self.assertEqual(parse_period_bound('2024-12', upper=True), datetime(2025, 1, 1))
+        self.assertEqual(parse_period_bound('2024-02-29', upper=True), datetime(2024, 3, 1))
+        self.assertEqual(parse_period_bound('2024-12-31', upper=True), datetime(2025, 1, 1))
+
+    def test_invalid(self):
+        for value in ('2024-13', '2024-0', '2024-02-30', '2023-02-29', '2024-1-1-1', '2024-01-01-00',
+                      '', 'abc', '2024-', '-2024', '2024/01', ' 2024', '+2024', '2024-01-01T10'):
+            for upper in (False, True):
+                with self.subTest(value=value, upper=upper), self.assertRaises(ValueError):
+                    parse_period_bound(value, upper=upper)
+
+
+if __name__ == '__main__':
+    unittest.main()